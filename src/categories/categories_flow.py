@@ -1,9 +1,8 @@
 from prefect import flow
 import polars as pl
 import networkx as nx
-from prefect_sqlalchemy import SqlAlchemyConnector
 
-from src.utils.db.crdb import db_write_dataframe
+from src.utils.db.crdb import staged_upsert, crdb_connect
 from src.utils.logging.loggers import get_logger
 
 
@@ -117,43 +116,42 @@ def categories_flow():
         )
     log.info(tree_df.glimpse())
 
-    db_write_dataframe(categories_df, "categories_load")
-    db_write_dataframe(
-        tree_df, "categories_tree_load", id_cols=["ancestor_id", "descendant_id"]
-    )
-    db_write_dataframe(
-        edges_df, "categories_edges_load", id_cols=["parent_id", "child_id"]
-    )
-
-    crdb = SqlAlchemyConnector.load("crdb-sage")
+    crdb = crdb_connect()
     crdb.execute("""
         UPSERT INTO public.categories (id, updated_at, name)
         VALUES ('CATEGORY_ROOT', NOW(), '{"xx": "Category Root"}');
     """)
-    crdb.execute("""
-        INSERT INTO public.categories (id, created_at, updated_at, name, "desc_short", "desc", image_url)
-        SELECT id, NOW(), NOW(), name::JSONB, "desc_short"::JSONB, "desc"::JSONB, image_url::STRING
-        FROM databot.categories_load
-        ON CONFLICT (id) DO UPDATE
-        SET name = JSON_STRIP_NULLS(EXCLUDED.name::JSONB),
-            "desc_short" = JSON_STRIP_NULLS(EXCLUDED."desc_short"::JSONB),
-            "desc" = JSON_STRIP_NULLS(EXCLUDED."desc"::JSONB),
-            image_url = EXCLUDED.image_url::STRING,
-            updated_at = NOW();
-    """)
-    crdb.execute("DROP TABLE IF EXISTS databot.categories_load;")
-    crdb.execute("""
-        UPSERT INTO public.category_tree (ancestor_id, descendant_id, depth)
-        SELECT ancestor_id, descendant_id, depth
-        FROM databot.categories_tree_load;
-    """)
-    crdb.execute("DROP TABLE IF EXISTS databot.categories_tree_load;")
-    crdb.execute("""
-        UPSERT INTO public.category_edges (parent_id, child_id)
-        SELECT parent_id, child_id
-        FROM databot.categories_edges_load;
-    """)
-    crdb.execute("DROP TABLE IF EXISTS databot.categories_edges_load;")
+    staged_upsert(
+        categories_df,
+        "categories",
+        {
+            "id": "id",
+            "created_at": "NOW()",
+            "updated_at": "NOW()",
+            "name": "JSON_STRIP_NULLS(name::JSONB)",
+            "desc_short": 'JSON_STRIP_NULLS("desc_short"::JSONB)',
+            "desc": 'JSON_STRIP_NULLS("desc"::JSONB)',
+            "image_url": "image_url::STRING",
+        },
+    )
+    staged_upsert(
+        tree_df,
+        "category_tree",
+        {
+            "ancestor_id": "ancestor_id",
+            "descendant_id": "descendant_id",
+            "depth": "depth",
+        },
+        key=["ancestor_id", "descendant_id"],
+        load_table="categories_tree_load",
+    )
+    staged_upsert(
+        edges_df,
+        "category_edges",
+        {"parent_id": "parent_id", "child_id": "child_id"},
+        key=["parent_id", "child_id"],
+        load_table="categories_edges_load",
+    )
 
 
 if __name__ == "__main__":
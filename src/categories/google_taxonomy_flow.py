@@ -1,10 +1,9 @@
 from prefect import flow, task
 import polars as pl
 import networkx as nx
-from prefect_sqlalchemy import SqlAlchemyConnector
 import nanoid
 
-from src.utils.db.crdb import db_write_dataframe
+from src.utils.db.crdb import db_write_dataframe, crdb_connect
 from src.utils.logging.loggers import get_logger
 
 
@@ -299,7 +298,7 @@ def categories_flow():
         edges_df, "categories_edges_load", id_cols=["parent_id", "child_id"]
     )
 
-    crdb = SqlAlchemyConnector.load("crdb-sage")
+    crdb = crdb_connect()
     crdb.execute("""
         UPSERT INTO public.categories (id, updated_at, name)
         VALUES ('CATEGORY_ROOT', NOW(), '{"xx": "Category Root"}');
@@ -1,11 +1,11 @@
 from prefect import flow
 import polars as pl
 from prefect.variables import Variable
-from prefect_sqlalchemy import SqlAlchemyConnector
 import meilisearch
 
 from src.cli import setup_cli
-from src.utils.db.crdb import db_write_dataframe
+from src.utils.db.crdb import staged_upsert
+from src.utils.db.meili import meili_match_column
 from src.utils.logging.loggers import get_logger
 
 
@@ -43,17 +43,10 @@ def components_flow(**kwargs):
     )
     comp_df = comp_df.drop(desc_cols.values())
 
-    def get_primary_mat(row):
-        mat = meili.index("materials").search(row, {"limit": 1})
-        if len(mat["hits"]) == 0:
-            return None
-        else:
-            return mat["hits"][0]["id"]
-
     comp_df = comp_df.with_columns(
-        pl.col("primary_material:en")
-        .map_elements(get_primary_mat)
-        .alias("primary_material_id")
+        meili_match_column(
+            meili, "materials", comp_df.get_column("primary_material:en")
+        ).alias("primary_material_id")
     )
     comp_df = comp_df.drop_nulls(pl.col("primary_material_id")).with_columns(
         pl.lit(None).cast(pl.String).alias("region_id"),
@@ -77,51 +70,40 @@ def components_flow(**kwargs):
         .with_columns(pl.col("material_fraction").cast(pl.Float32))
     )
 
-    def get_mat(row):
-        mat = meili.index("materials").search(row[0], {"limit": 1})
-        if len(mat["hits"]) == 0:
-            return None
-        else:
-            return mat["hits"][0]["id"]
-
     comp_mat_df = comp_mat_df.with_columns(
-        comp_mat_df.select(pl.col("materials")).map_rows(get_mat)
-    )
-    comp_mat_df = comp_mat_df.rename({"map": "material_id"}).drop_nulls(
-        pl.col("material_id")
-    )
+        meili_match_column(
+            meili, "materials", comp_mat_df.get_column("materials")
+        ).alias("material_id")
+    ).drop_nulls(pl.col("material_id"))
     comp_mat_df = comp_mat_df.select(
         pl.col("component_id", "material_id", "material_fraction")
     ).drop_nulls(pl.col("material_id"))
 
-    db_write_dataframe(comp_df, "components_load")
-    db_write_dataframe(
+    staged_upsert(
+        comp_df,
+        "components",
+        {
+            "id": "id",
+            "created_at": "NOW()",
+            "updated_at": "NOW()",
+            "name": "JSON_STRIP_NULLS(name::JSONB)",
+            "desc": 'JSON_STRIP_NULLS("desc"::JSONB)',
+            "region_id": "region_id",
+            "primary_material_id": "primary_material_id",
+            "visual": "JSON_STRIP_NULLS(visual::JSONB)",
+        },
+    )
+    staged_upsert(
         comp_mat_df,
-        "components_materials_load",
-        id_cols=["component_id", "material_id"],
+        "components_materials",
+        {
+            "component_id": "component_id",
+            "material_id": "material_id",
+            "material_fraction": "material_fraction",
+        },
+        key=["component_id", "material_id"],
     )
 
-    crdb = SqlAlchemyConnector.load("crdb-sage")
-    crdb.execute("""
-        INSERT INTO public.components (id, created_at, updated_at, name, "desc", region_id, primary_material_id, visual)
-        SELECT id, NOW(), NOW(), name::JSONB, "desc"::JSONB, region_id, primary_material_id, visual::JSONB
-        FROM databot.components_load
-        ON CONFLICT (id) DO UPDATE
-        SET name = JSON_STRIP_NULLS(EXCLUDED.name::JSONB),
-            "desc" = JSON_STRIP_NULLS(EXCLUDED."desc"::JSONB),
-            region_id = EXCLUDED.region_id,
-            primary_material_id = EXCLUDED.primary_material_id,
-            visual = JSON_STRIP_NULLS(EXCLUDED.visual::JSONB),
-            updated_at = NOW();
-    """)
-    crdb.execute("""
-        UPSERT INTO public.components_materials (component_id, material_id, material_fraction)
-        SELECT component_id, material_id, material_fraction
-        FROM databot.components_materials_load;
-    """)
-    crdb.execute("DROP TABLE IF EXISTS databot.components_load;")
-    crdb.execute("DROP TABLE IF EXISTS databot.components_materials_load;")
-
 
 if __name__ == "__main__":
     setup_cli(components_flow)
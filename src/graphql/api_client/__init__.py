@@ -75,6 +75,10 @@ from .input_types import (
     VariantRegionsInput,
     VariantTagsInput,
 )
+from .mark_source_processed import (
+    MarkSourceProcessed,
+    MarkSourceProcessedMarkSourceProcessed,
+)
 from .update_item import UpdateItem, UpdateItemUpdateItem, UpdateItemUpdateItemItem
 from .update_org import UpdateOrg, UpdateOrgUpdateOrg, UpdateOrgUpdateOrgOrg
 from .update_source import (
@@ -138,6 +142,8 @@ __all__ = [
     "GraphQLClientInvalidResponseError",
     "ItemCategoriesInput",
     "ItemTagsInput",
+    "MarkSourceProcessed",
+    "MarkSourceProcessedMarkSourceProcessed",
     "ProcessMaterialInput",
     "ProcessOrgInput",
     "ProcessPlaceInput",
@@ -23,6 +23,7 @@ from .input_types import (
     UpdateSourceInput,
     UpdateVariantInput,
 )
+from .mark_source_processed import MarkSourceProcessed
 from .update_item import UpdateItem
 from .update_org import UpdateOrg
 from .update_source import UpdateSource
@@ -224,6 +225,26 @@ class Client(BaseClient):
         data = self.get_data(response)
         return UpdateSource.model_validate(data)
 
+    def mark_source_processed(self, id: str, **kwargs: Any) -> MarkSourceProcessed:
+        query = gql(
+            """
+            mutation MarkSourceProcessed($id: ID!) {
+              markSourceProcessed(id: $id) {
+                success
+              }
+            }
+            """
+        )
+        variables: Dict[str, object] = {"id": id}
+        response = self.execute(
+            query=query,
+            operation_name="MarkSourceProcessed",
+            variables=variables,
+            **kwargs
+        )
+        data = self.get_data(response)
+        return MarkSourceProcessed.model_validate(data)
+
     def get_variant(
         self,
         first: Union[Optional[int], UnsetType] = UNSET,
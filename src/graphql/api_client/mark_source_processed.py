@@ -0,0 +1,21 @@
+# Generated by ariadne-codegen
+# Source: src/graphql/queries
+
+from typing import Optional
+
+from pydantic import Field
+
+from .base_model import BaseModel
+
+
+class MarkSourceProcessed(BaseModel):
+    mark_source_processed: Optional["MarkSourceProcessedMarkSourceProcessed"] = Field(
+        alias="markSourceProcessed"
+    )
+
+
+class MarkSourceProcessedMarkSourceProcessed(BaseModel):
+    success: Optional[bool]
+
+
+MarkSourceProcessed.model_rebuild()
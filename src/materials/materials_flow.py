@@ -1,9 +1,8 @@
 from prefect import flow
 import polars as pl
 import networkx as nx
-from prefect_sqlalchemy import SqlAlchemyConnector
 
-from src.utils.db.crdb import db_write_dataframe
+from src.utils.db.crdb import staged_upsert, crdb_connect
 from src.utils.logging.loggers import get_logger
 
 
@@ -107,44 +106,43 @@ def materials_flow():
         )
     log.info(tree_df.glimpse())
 
-    db_write_dataframe(materials_df, "materials_load")
-    db_write_dataframe(
-        tree_df, "materials_tree_load", id_cols=["ancestor_id", "descendant_id"]
-    )
-    db_write_dataframe(
-        edges_df, "materials_edges_load", id_cols=["parent_id", "child_id"]
-    )
-
-    crdb = SqlAlchemyConnector.load("crdb-sage")
+    crdb = crdb_connect()
     crdb.execute("""
         UPSERT INTO public.materials (id, updated_at, name, source, technical)
         VALUES ('MATERIAL_ROOT', NOW(), '{"xx": "Material Root"}', '{}', FALSE);
     """)
-    crdb.execute("""
-        INSERT INTO public.materials (id, created_at, updated_at, name, "desc", source, technical, shape)
-        SELECT id, NOW(), NOW(), name::JSONB, "desc"::JSONB, source::JSONB, technical::BOOLEAN, shape
-        FROM databot.materials_load
-        ON CONFLICT (id) DO UPDATE
-        SET name = JSON_STRIP_NULLS(EXCLUDED.name::JSONB),
-            "desc" = JSON_STRIP_NULLS(EXCLUDED."desc"::JSONB),
-            source = EXCLUDED.source::JSONB,
-            technical = EXCLUDED.technical::BOOLEAN,
-            shape = EXCLUDED.shape,
-            updated_at = NOW();
-    """)
-    crdb.execute("DROP TABLE IF EXISTS databot.materials_load;")
-    crdb.execute("""
-        UPSERT INTO public.material_tree (ancestor_id, descendant_id, depth)
-        SELECT ancestor_id, descendant_id, depth
-        FROM databot.materials_tree_load;
-    """)
-    crdb.execute("DROP TABLE IF EXISTS databot.materials_tree_load;")
-    crdb.execute("""
-        UPSERT INTO public.material_edges (parent_id, child_id)
-        SELECT parent_id, child_id
-        FROM databot.materials_edges_load;
-    """)
-    crdb.execute("DROP TABLE IF EXISTS databot.materials_edges_load;")
+    staged_upsert(
+        materials_df,
+        "materials",
+        {
+            "id": "id",
+            "created_at": "NOW()",
+            "updated_at": "NOW()",
+            "name": "JSON_STRIP_NULLS(name::JSONB)",
+            "desc": 'JSON_STRIP_NULLS("desc"::JSONB)',
+            "source": "source::JSONB",
+            "technical": "technical::BOOLEAN",
+            "shape": "shape",
+        },
+    )
+    staged_upsert(
+        tree_df,
+        "material_tree",
+        {
+            "ancestor_id": "ancestor_id",
+            "descendant_id": "descendant_id",
+            "depth": "depth",
+        },
+        key=["ancestor_id", "descendant_id"],
+        load_table="materials_tree_load",
+    )
+    staged_upsert(
+        edges_df,
+        "material_edges",
+        {"parent_id": "parent_id", "child_id": "child_id"},
+        key=["parent_id", "child_id"],
+        load_table="materials_edges_load",
+    )
 
 
 if __name__ == "__main__":
@@ -2,7 +2,6 @@ from prefect import flow
 from prefect.variables import Variable
 from prefect.blocks.system import Secret
 import polars as pl
-from prefect_sqlalchemy import SqlAlchemyConnector
 import json
 import httpx
 import time
@@ -18,8 +17,12 @@ from src.graphql.api_client.client import (
 from src.utils.logging.loggers import get_logger
 from src.utils import slugify
 from src.utils.api import api_connect
-from src.utils.db.crdb import create_polars_uri, db_write_dataframe
-from src.utils.db.meili import meili_connect
+from src.utils.db.crdb import (
+    crdb_connect,
+    fetch_rows,
+    iter_table_batches,
+)
+from src.utils.fuzzy import TrigramMatcher
 
 
 @flow
@@ -31,18 +34,20 @@ def off_variants_flow():
     log = get_logger()
 
     # Load the data from the database
-    crdb = SqlAlchemyConnector.load("crdb-sage")
+    crdb = crdb_connect()
 
-    # Connect to Meilisearch
-    meili = meili_connect()
+    # Match brands to orgs in process instead of one search per brand
+    org_matcher = TrigramMatcher.from_table("public.orgs", translations=False)
+    org_ids: dict[str, str] = {}
 
     # Create an API client
     client, user = api_connect(crdb=crdb)
 
     # Ensure the OFF source exists
     off_source_id = "g6OJVnSzQkE0mHtYS31O9"
-    off_source = crdb.fetch_all(
-        "SELECT * FROM public.sources WHERE type = 'API' AND location = 'https://world.openfoodfacts.org'"
+    off_source = fetch_rows(
+        crdb,
+        "SELECT * FROM public.sources WHERE type = 'API' AND location = 'https://world.openfoodfacts.org'",
     )
     if len(off_source) == 0:
         crdb.execute(
@@ -50,7 +55,8 @@ def off_variants_flow():
             f"'{off_source_id}', 'API', 'https://world.openfoodfacts.org', '{user[0]}')"
         )
     # Fetch variant tag definitions
-    tag_defs = crdb.fetch_all(
+    tag_defs = fetch_rows(
+        crdb,
         "SELECT id, tag_id, meta_template FROM public.tags WHERE type = 'VARIANT'",
     )
     origins_def = None
@@ -61,31 +67,38 @@ def off_variants_flow():
 
     ITER_SIZE = 1_000
     cursor: str = "off_"
-    while True:
-        crdb.close()
-        off_cur = crdb.fetch_all(
-            f"SELECT * FROM databot.off_products WHERE id > '{cursor}' LIMIT {ITER_SIZE}",
-        )
-        off_df = pl.from_records(off_cur)
-        if off_df.is_empty():
-            log.info("No more data to process.")
-            break
-        off_cur = None
+    for off_df in iter_table_batches(
+        "databot.off_products", batch_size=ITER_SIZE, after=[cursor]
+    ):
         start_cursor = cursor
         cursor = off_df.select(pl.col("id")).tail(1).to_series().item()
-        variants_cur = crdb.fetch_all(
-            f"""
+        variants_cur = fetch_rows(
+            crdb,
+            """
               SELECT s.source_id, s.variant_id, v.*
               FROM public.external_sources s
               LEFT JOIN public.variants v ON v.id = s.variant_id
-              WHERE s.source = 'OFF' AND s.source_id > '{start_cursor.removeprefix("off_")}'
-              AND s.source_id <= '{cursor.removeprefix("off_")}'
+              WHERE s.source = 'OFF' AND s.source_id > :start AND s.source_id <= :end
               ORDER BY s.source_id
             """,
+            {
+                "start": start_cursor.removeprefix("off_"),
+                "end": cursor.removeprefix("off_"),
+            },
         )
         variants_df = pl.from_records(variants_cur)
         variants_cur = None
 
+        batch_brands = {
+            brand.strip()
+            for value in off_df.get_column("brands").drop_nulls()
+            for brand in value.split(",")
+        }
+        best = org_matcher.match(
+            [b for b in batch_brands if b != "" and b not in org_ids], threshold=0.5
+        )
+        org_ids.update(zip(best.get_column("query"), best.get_column("id")))
+
         log.info(
             f"Processing {off_df.height} rows from databot.off_variants and {variants_df.height} rows from public.external_sources"
         )
@@ -164,20 +177,11 @@ def off_variants_flow():
                 orgs = []
                 for brand in brands:
                     brand = brand.strip()
-                    try:
-                        matching_orgs = meili.index("orgs").search(
-                            brand, {"rankingScoreThreshold": 0.5, "limit": 1}
-                        )
-                    except Exception as e:
-                        time.sleep(5)
-                        matching_orgs = meili.index("orgs").search(
-                            brand, {"rankingScoreThreshold": 0.5, "limit": 1}
-                        )
-                    if len(matching_orgs["hits"]) > 0:
-                        org = matching_orgs["hits"][0]
-                        # Update the org
-                        log.info(f"Matching orgs: {matching_orgs['hits']}")
-                        orgs.append({"id": org["id"]})
+                    if brand == "":
+                        continue
+                    if brand in org_ids:
+                        log.info(f"Matching org for {brand}: {org_ids[brand]}")
+                        orgs.append({"id": org_ids[brand]})
                     else:
                         # Create a new org
                         org = CreateOrgInput(name=brand, slug=slugify(brand))
@@ -189,6 +193,7 @@ def off_variants_flow():
                             time.sleep(0.1)
                             continue
                         time.sleep(0.1)
+                        org_ids[brand] = op.create_org.org.id
                         orgs.append({"id": op.create_org.org.id})
 
             if variant_id:
@@ -213,6 +218,7 @@ def off_variants_flow():
                 f"INSERT INTO public.external_sources (source, source_id, variant_id) VALUES ('OFF', '{row['id'].removeprefix('off_')}', '{op.create_variant.variant.id}')"
             )
             time.sleep(0.1)
+    log.info("No more data to process.")
 
 
 if __name__ == "__main__":
@@ -1,17 +1,29 @@
 from prefect import flow, task
 from prefect.variables import Variable
-from prefect_sqlalchemy import SqlAlchemyConnector
 import polars as pl
 import osmium as osm
+from osmium.replication.server import ReplicationServer
+from osmium.replication.utils import get_replication_header
 import json
+import os
 
 from src.openstreetmap.generators import generate_name, generate_address
 from src.openstreetmap.osm_tags import waste_tags
-from src.utils import download_cache_file
+from src.utils import download_cache_file, write_checksum
 from src.utils.logging.loggers import get_logger
-from src.utils.db.crdb import create_polars_uri
+from src.utils.db.crdb import staged_upsert, crdb_connect
 from src.cli import setup_cli
 
+places_schema = {
+    "id": pl.Utf8,
+    "name": pl.Utf8,
+    "address": pl.Utf8,
+    "geom": pl.Utf8,
+    "osm": pl.Utf8,
+}
+
+wkb_factory = osm.geom.WKBFactory()
+
 
 @task
 def load_osm(country: str, download_url: str):
@@ -39,68 +51,142 @@ def construct_osm_json(o):
     return json.dumps(json_obj, ensure_ascii=False)
 
 
-@task
-def transform_osm(filepath: str):
+def osm_place_id(o) -> str:
     """
-    Transform the OSM data.
+    Get the places table id for an OSM object.
+    Areas keep the id of the way or relation they were assembled from.
     """
-    log = get_logger()
+    if o.is_node():
+        return f"node_{o.id}"
+    if o.is_way():
+        return f"way_{o.id}"
+    if o.is_area():
+        if o.from_way():
+            return f"way_{o.orig_id()}"
+        return f"relation_{o.orig_id()}"
+    return f"relation_{o.id}"
 
-    places_df = pl.DataFrame(
-        schema={
-            "id": pl.Utf8,
-            "name": pl.Utf8,
-            "address": pl.Utf8,
-            "location": pl.Utf8,
-            "osm": pl.Utf8,
-        }
+
+def osm_place_row(o) -> tuple | None:
+    """
+    Construct a places row from an OSM node, open way or area.
+    Returns None for objects that cannot be turned into a place.
+
+    The geometry is stored as hex WKB, the location is computed from it
+    in bulk by the database during the upsert.
+    """
+    try:
+        if o.is_node():
+            geom = wkb_factory.create_point(o)
+        elif o.is_way():
+            # Closed ways are handled by the area assembler
+            if len(o.nodes) < 2 or o.is_closed():
+                return None
+            geom = wkb_factory.create_linestring(o)
+        elif o.is_area():
+            geom = wkb_factory.create_multipolygon(o)
+        else:
+            return None
+    except (osm.InvalidLocationError, RuntimeError):
+        return None
+    return (
+        osm_place_id(o),
+        json.dumps(generate_name(o.tags), ensure_ascii=False),
+        json.dumps(generate_address(o.tags), ensure_ascii=False),
+        geom,
+        construct_osm_json(o),
     )
 
-    pbf = (
+
+def osm_places_processor(filepath: str) -> osm.FileProcessor:
+    """
+    Create a processor for all nodes, ways and areas matching the waste tags.
+    Multipolygon relations and closed ways are assembled into areas.
+    """
+    return (
         osm.FileProcessor(filepath)
         .with_locations()
+        .with_areas(osm.filter.TagFilter(*waste_tags))
         .with_filter(osm.filter.TagFilter(*waste_tags))
     )
+
+
+def load_osm_places(places_df: pl.DataFrame):
+    """
+    Write the places rows to the load table and upsert them into public.places.
+    """
+    staged_upsert(
+        places_df,
+        "places",
+        {
+            "id": "id",
+            "created_at": "NOW()",
+            "updated_at": "NOW()",
+            "name": "JSON_STRIP_NULLS(name::JSONB)",
+            "address": "JSON_STRIP_NULLS(address::JSONB)",
+            "location": "ST_POINTONSURFACE(ST_GEOMFROMWKB(DECODE(geom, 'hex'), 4326))::GEOGRAPHY",
+            "osm": "osm::JSONB",
+        },
+        load_table="places_osm_load",
+    )
+
+
+def delete_osm_places(ids: list[str], chunk_size: int = 10_000) -> int:
+    """
+    Delete places that were removed from OSM or no longer match the waste tags.
+
+    The ids are only candidates. Each chunk is deleted with one statement,
+    which only removes the ids that are places. Returns the number deleted.
+    """
+    crdb = crdb_connect()
+    deleted = 0
+    for i in range(0, len(ids), chunk_size):
+        result = crdb.execute(
+            "DELETE FROM public.places WHERE id = ANY(:ids)",
+            {"ids": ids[i : i + chunk_size]},
+        )
+        deleted += result.rowcount
+    return deleted
+
+
+def replication_variable(country: str) -> str:
+    return f"osm_replication_{country.lower()}"
+
+
+def store_replication_state(country: str, base_url: str, sequence: int):
+    """
+    Store the replication server and last applied sequence number for a country.
+    """
+    Variable.set(
+        replication_variable(country),
+        {"url": base_url, "sequence": sequence},
+        tags=["osm", "replication"],
+        overwrite=True,
+    )
+
+
+@task
+def transform_osm(filepath: str):
+    """
+    Transform the OSM data.
+    """
+    log = get_logger()
+
+    places_df = pl.DataFrame(schema=places_schema)
+
+    pbf = osm_places_processor(filepath)
     rows = []
     total = 0
     for o in pbf:
-        if o.is_node():
-            node = (
-                f"node_{o.id}",
-                json.dumps(generate_name(o.tags), ensure_ascii=False),
-                json.dumps(generate_address(o.tags), ensure_ascii=False),
-                f"SRID=4326;POINT({o.location.lon} {o.location.lat})",
-                construct_osm_json(o),
-            )
-            rows.append(node)
-        if o.is_way():
-            if len(o.nodes) == 0:
-                continue
-            lons = []
-            lats = []
-            for n in o.nodes:
-                lons.append(n.lon)
-                lats.append(n.lat)
-            loc = None
-            if len(lons) > 0:
-                loc = (
-                    f"SRID=4326;POINT({sum(lons) / len(lons)} {sum(lats) / len(lats)})"
-                )
-            way = (
-                f"way_{o.id}",
-                json.dumps(generate_name(o.tags), ensure_ascii=False),
-                json.dumps(generate_address(o.tags), ensure_ascii=False),
-                loc,
-                construct_osm_json(o),
-            )
-            rows.append(way)
-        if o.is_relation():
-            # TODO: Should we handle relations?
-            continue
-        if len(rows) % 1000 == 0:
+        row = osm_place_row(o)
+        if row is not None:
+            rows.append(row)
+        if len(rows) >= 1000:
             total += len(rows)
             log.info(f"Processed {total} rows...")
-            places_df = places_df.vstack(pl.DataFrame(rows, schema=places_df.schema))
+            places_df = places_df.vstack(
+                pl.DataFrame(rows, schema=places_df.schema, orient="row")
+            )
             rows = []
     if len(rows) > 0:
         total += len(rows)
@@ -110,38 +196,132 @@ def transform_osm(filepath: str):
         )
         rows = []
 
-    crdb = SqlAlchemyConnector.load("crdb-sage")
-    conn = create_polars_uri(crdb)
+    load_osm_places(places_df)
 
-    places_df.write_database(
-        connection=conn,
-        table_name="databot.places_osm_load",
-        if_table_exists="replace",
-        engine="adbc",
-    )
 
-    crdb.execute("ALTER TABLE databot.places_osm_load ALTER COLUMN id SET NOT NULL;")
-    crdb.execute(
-        "ALTER TABLE databot.places_osm_load ALTER PRIMARY KEY USING COLUMNS (id);"
+class ChangeCollector(osm.SimpleHandler):
+    """
+    Collects the ids of all objects touched by a set of replication diffs.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.nodes = set()
+        self.ways = set()
+        self.relations = set()
+        self.deleted = []
+
+    def node(self, n):
+        self.nodes.add(n.id)
+        if n.deleted:
+            self.deleted.append(f"node_{n.id}")
+
+    def way(self, w):
+        self.ways.add(w.id)
+        if w.deleted:
+            self.deleted.append(f"way_{w.id}")
+
+    def relation(self, r):
+        self.relations.add(r.id)
+        if r.deleted:
+            self.deleted.append(f"relation_{r.id}")
+
+
+@task
+def update_osm(country: str, filepath: str, max_size: int = 1024 * 1024):
+    """
+    Apply the replication diffs published since the last import to the cached
+    OSM file and update only the places touched by those diffs.
+
+    Returns False if there is no stored replication state for the country,
+    in which case a full import is required.
+    """
+    log = get_logger()
+
+    state = Variable.get(replication_variable(country), default=None)
+    if not state:
+        log.info(f"No replication state stored for {country}.")
+        return False
+
+    repserv = ReplicationServer(state["url"])
+    diffs = repserv.collect_diffs(state["sequence"] + 1, max_size=max_size)
+    if diffs is None:
+        log.info(f"No new diffs for {country} since sequence {state['sequence']}.")
+        return True
+    log.info(f"Applying diffs {state['sequence'] + 1} to {diffs.id} for {country}")
+
+    # Merge the diffs into the cached file so the next run starts from here
+    updated_path = filepath + ".new.osm.pbf"
+    if os.path.exists(updated_path):
+        os.remove(updated_path)
+    reader = osm.io.Reader(filepath)
+    header = osm.io.Header()
+    header.set("osmosis_replication_base_url", state["url"])
+    header.set("osmosis_replication_sequence_number", str(diffs.id))
+    writer = osm.io.Writer(updated_path, header)
+    diffs.reader.apply_to_reader(reader, writer)
+    reader.close()
+    writer.close()
+    os.replace(updated_path, filepath)
+    write_checksum(filepath)
+
+    # Collecting the changes has to happen after the merge, applying the diffs
+    # to a handler first drops the deletions from the merged output
+    changes = ChangeCollector()
+    diffs.reader.apply(changes, simplify=True)
+
+    # Re-evaluate the waste tags on the touched objects only. Ways and areas
+    # are also touched if any of their nodes moved.
+    pbf = osm_places_processor(filepath)
+    matched = set()
+    rows = []
+    for o in pbf:
+        if o.is_node():
+            if o.id not in changes.nodes:
+                continue
+        elif o.is_way():
+            if o.id not in changes.ways and not any(
+                n.ref in changes.nodes for n in o.nodes
+            ):
+                continue
+        elif o.is_area():
+            touched = changes.ways if o.from_way() else changes.relations
+            if o.orig_id() not in touched and not any(
+                n.ref in changes.nodes for ring in o.outer_rings() for n in ring
+            ):
+                continue
+        else:
+            continue
+        row = osm_place_row(o)
+        if row is not None:
+            matched.add(row[0])
+            rows.append(row)
+
+    # Touched objects that no longer match the waste tags are removed as well
+    removed = set(changes.deleted)
+    removed.update(f"node_{i}" for i in changes.nodes if f"node_{i}" not in matched)
+    removed.update(f"way_{i}" for i in changes.ways if f"way_{i}" not in matched)
+    removed.update(
+        f"relation_{i}" for i in changes.relations if f"relation_{i}" not in matched
     )
-    crdb.execute("""
-        INSERT INTO public.places (id, created_at, updated_at, name, address, location, osm)
-        SELECT id, NOW(), NOW(), name::JSONB, address::JSONB, ST_GEOGFROMEWKT(location::TEXT), osm::JSONB
-        FROM databot.places_osm_load
-        ON CONFLICT (id) DO UPDATE
-        SET name = JSON_STRIP_NULLS(EXCLUDED.name::JSONB),
-            address = JSON_STRIP_NULLS(EXCLUDED.address::JSONB),
-            location = ST_GEOGFROMEWKT(EXCLUDED.location::TEXT),
-            osm = EXCLUDED.osm::JSONB,
-            updated_at = NOW();
-    """)
-    crdb.execute("DROP TABLE IF EXISTS databot.places_osm_load;")
+
+    log.info(f"Upserting {len(rows)} places, {len(removed)} delete candidates")
+    if len(rows) > 0:
+        load_osm_places(pl.DataFrame(rows, schema=places_schema, orient="row"))
+    deleted = delete_osm_places(sorted(removed))
+    log.info(f"Deleted {deleted} places")
+
+    store_replication_state(country, state["url"], diffs.id)
+    return True
 
 
 @flow
-def import_osm_places(country: list[str], **kwargs):
+def import_osm_places(country: list[str], incremental: bool = False, **kwargs):
     """
     This flow imports the OSM places data.
+
+    With incremental set, the replication diffs since the last import are
+    applied instead of reprocessing the whole country file.
     """
     log = get_logger()
 
@@ -155,8 +335,17 @@ def import_osm_places(country: list[str], **kwargs):
         f"https://download.geofabrik.de/europe/{country.lower()}-latest.osm.pbf"
     )
     filepath = load_osm(country, download_url)
+    if incremental and update_osm(country, filepath):
+        return
     transform_osm(filepath)
 
+    # Remember where the file is in the replication stream for incremental runs
+    base_url, sequence, _ = get_replication_header(filepath)
+    if base_url and sequence:
+        store_replication_state(country, base_url, sequence)
+    else:
+        log.warning(f"{filepath} has no replication header, incremental disabled.")
+
 
 if __name__ == "__main__":
 
@@ -167,5 +356,11 @@ if __name__ == "__main__":
             nargs="+",
             help="The country to process.",
         )
+        parser.add_argument(
+            "--incremental",
+            action="store_true",
+            default=False,
+            help="Apply replication diffs since the last import",
+        )
 
     setup_cli(import_osm_places, args)
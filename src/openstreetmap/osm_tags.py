@@ -49,3 +49,16 @@ waste_tags = [
     ("recycling:food_waste", "yes"),
     ("recycling:food_waste", "no"),
 ]
+
+# Maps OSM keys to Sage place tags as (tag_id, meta field).
+# Keys ending with ":" match every OSM key with that prefix, and the longest
+# matching prefix wins.
+place_tag_rules = {
+    "opening_hours": ("opening_hours", "opening_hours"),
+    "operator": ("operator", "operator"),
+    "website": ("website", "website"),
+    "contact:website": ("website", "website"),
+    "fee": ("fee", "fee"),
+    "recycling_type": ("recycling", "type"),
+    "recycling:": ("recycling", "materials"),
+}
@@ -1,27 +1,84 @@
 from prefect import flow
-from prefect_sqlalchemy import SqlAlchemyConnector
 import json
-from jsonschema import validate
+from jsonschema import Draft202012Validator
 
+from src.openstreetmap.osm_tags import place_tag_rules
 from src.utils.logging.loggers import get_logger
+from src.utils.db.crdb import crdb_connect, fetch_rows, iter_table_batches
 
 
-def process_tag(tag_defs: dict[str, tuple], t: str, v: str) -> tuple[str, dict]:
+def set_meta(meta: dict, field: str, k: str, v: str):
+    meta[field] = v
+
+
+def add_material(meta: dict, field: str, k: str, v: str):
+    """
+    Collect recycling:<material>=yes/no values into accepts/rejects lists.
+    """
+    material = k.split(":", 1)[1]
+    if v == "yes":
+        meta.setdefault("accepts", []).append(material)
+    elif v == "no":
+        meta.setdefault("rejects", []).append(material)
+
+
+meta_handlers = {
+    "materials": add_material,
+}
+
+
+class PlaceTagRules:
     """
-    Check if a tag relation should be created.
+    Maps OSM tags to Sage place tags using a precomputed dispatch table.
+    Only rules for tags that exist in the database are kept and the JSON
+    schema of each tag is compiled once.
     """
-    if t == "opening_hours":
-        tag_tmpl = tag_defs.get("opening_hours")
-        if tag_tmpl:
-            meta = None
-            if "schema" in tag_tmpl[1]:
-                meta = {"opening_hours": v}
-                try:
-                    validate(meta, tag_tmpl[1]["schema"])
-                except Exception:
-                    return None
-            return (tag_tmpl[0], json.dumps(meta, ensure_ascii=False))
-    return None
+
+    def __init__(self, tag_defs: dict[str, tuple]):
+        self.rules = {}
+        self.prefix_rules = {}
+        self.tags = {}
+        for osm_key, (tag_id, field) in place_tag_rules.items():
+            tag_tmpl = tag_defs.get(tag_id)
+            if not tag_tmpl:
+                continue
+            if tag_id not in self.tags:
+                validator = None
+                if tag_tmpl[1] and "schema" in tag_tmpl[1]:
+                    validator = Draft202012Validator(tag_tmpl[1]["schema"])
+                self.tags[tag_id] = (tag_tmpl[0], validator)
+            rule = (tag_id, field, meta_handlers.get(field, set_meta))
+            if osm_key.endswith(":"):
+                self.prefix_rules[osm_key] = rule
+            else:
+                self.rules[osm_key] = rule
+
+    def apply(self, osm_tags: dict[str, str]) -> list[tuple[str, str]]:
+        """
+        Get the (tag id, meta JSON) relations for the tags of one place.
+        """
+        metas = {}
+        for k, v in osm_tags.items():
+            rule = self.rules.get(k)
+            # Try the prefixes of the key from the longest to the shortest
+            i = k.rfind(":")
+            while rule is None and i >= 0:
+                rule = self.prefix_rules.get(k[: i + 1])
+                i = k.rfind(":", 0, i)
+            if rule is None:
+                continue
+            tag_id, field, handler = rule
+            handler(metas.setdefault(tag_id, {}), field, k, v)
+
+        relations = []
+        for tag_id, meta in metas.items():
+            if len(meta) == 0:
+                continue
+            db_id, validator = self.tags[tag_id]
+            if validator is not None and not validator.is_valid(meta):
+                continue
+            relations.append((db_id, json.dumps(meta, ensure_ascii=False)))
+        return relations
 
 
 @flow
@@ -31,28 +88,43 @@ def osm_tags_flow():
     """
     log = get_logger()
 
-    crdb = SqlAlchemyConnector.load("crdb-sage")
+    crdb = crdb_connect()
 
     # Fetch all tags from the database
-    tags_cur = crdb.fetch_all(
+    tags_cur = fetch_rows(
+        crdb,
         "SELECT id, meta_template, tag_id FROM tags WHERE type = 'PLACE'",
     )
     tag_defs = dict((row[2], row) for row in tags_cur)
+    tag_rules = PlaceTagRules(tag_defs)
 
-    # Scan the places table for OSM tags by parsing the osm column
-    places_cur = crdb.fetch_all(
-        "SELECT id, osm FROM places WHERE osm IS NOT NULL", {"yield_per": 1000}
-    )
+    if len(tag_rules.rules) == 0 and len(tag_rules.prefix_rules) == 0:
+        log.warning("No place tags with OSM rules found in the database.")
+        return
+    keys = list(tag_rules.rules.keys())
+    prefixes = [p + "%" for p in tag_rules.prefix_rules.keys()]
+
+    # Scan the places table with keyset pagination, only fetching the tags
+    # of places that have at least one key matched by the rules
+    PAGE_SIZE = 1_000
     relations = []
     total_rel = 0
-    for row in places_cur:
-        osm = row[1]
-        for t, v in osm["tags"].items():
-            relation = process_tag(tag_defs, t, v)
-            if relation:
-                relations.append(
-                    {"place_id": row[0], "tag_id": relation[0], "meta": relation[1]}
-                )
+    for places_df in iter_table_batches(
+        "public.places",
+        "id, (osm->'tags')::STRING AS tags",
+        batch_size=PAGE_SIZE,
+        where="""
+            osm IS NOT NULL
+            AND (osm->'tags' ?| :keys OR EXISTS (
+                SELECT 1 FROM jsonb_object_keys(osm->'tags') AS k
+                WHERE k LIKE ANY (:prefixes)
+            ))
+        """,
+        params={"keys": keys, "prefixes": prefixes},
+    ):
+        for place_id, tags in places_df.iter_rows():
+            for tag_id, meta in tag_rules.apply(json.loads(tags)):
+                relations.append({"place_id": place_id, "tag_id": tag_id, "meta": meta})
         if len(relations) >= 1000:
             total_rel += len(relations)
             log.info(f"Found {total_rel} tag relations...")
@@ -76,7 +148,6 @@ def osm_tags_flow():
         )
         relations = []
     log.info("Finished processing all places.")
-    crdb.close()
 
 
 if __name__ == "__main__":
@@ -1,49 +1,40 @@
 from prefect import flow, task
+from prefect.variables import Variable
 from prefect.utilities.annotations import quote
 from unstructured.documents.elements import Element
 from unstructured.staging.base import elements_from_json
-import fasttext
-import spacy
 import json
 
 from src.cli import setup_cli
 from src.utils.api import api_connect
 from src.graphql.api_client.client import CreateSourceInput, UpdateSourceInput
 from src.utils.logging.loggers import get_logger
-from src.utils.lang import LANG_TO_SPACY_MODEL
+from src.utils.lang import LANG_TO_SPACY_MODEL, detect_language, spacy_model
+from src.utils.gazetteer import region_gazetteer
 
 
 @task
-def detect_language(text: str) -> str:
+def detect_regions(
+    lang: str, content: list[Element], batch_size: int = 64, n_process: int = 1
+) -> list[dict]:
     """
-    Detects the language of the given text using FastText.
-    """
-    model = fasttext.load_model("data/lid.176.bin")
-    predictions = model.predict(text)
-    return predictions[0][0].split("__")[-1]
-
-
-@task
-def detect_regions(nlp, content: list[Element]) -> list[str]:
-    """
-    Detects regions in the given content using Spacy.
+    Detects regions in the given content using Spacy and a region gazetteer.
     """
     log = get_logger()
 
-    regions = []
-    propn = []
-    for p in content:
-        if p.text:
-            doc = nlp(p.text)
-            for w in doc:
-                if w.pos_ == "PROPN":
-                    propn.append(w.text)
-    log.info(f"Searching regions for: {propn}")
-    return regions
+    nlp = spacy_model(lang)
+    gazetteer = region_gazetteer(nlp, Variable.get("cache_dir", default="data"))
+    regions = {}
+    texts = [p.text for p in content if p.text]
+    for doc in nlp.pipe(texts, batch_size=batch_size, n_process=n_process):
+        for match in gazetteer.match(doc):
+            regions.setdefault(match["id"], match)
+    log.info(f"Found regions: {[r['text'] for r in regions.values()]}")
+    return list(regions.values())
 
 
 @flow
-def extract_processes_flow(source_id: list[str], **kwargs):
+def extract_processes_flow(source_id: list[str], n_process: int = 1, **kwargs):
     """
     Creates a source in the database and uploads attached files to S3 if any.
     """
@@ -75,8 +66,7 @@ def extract_processes_flow(source_id: list[str], **kwargs):
         raise ValueError(f"Detected language {lang} not supported")
     log.info(f"Detected language: {lang}")
     log.info(f"Processing {len(content)} elements")
-    nlp = spacy.load(LANG_TO_SPACY_MODEL[lang])
-    detect_regions(quote(nlp), content)
+    detect_regions(lang, quote(content), n_process=n_process)
 
 
 if __name__ == "__main__":
@@ -88,5 +78,11 @@ if __name__ == "__main__":
             nargs="+",
             help="The source ID to process.",
         )
+        parser.add_argument(
+            "--n-process",
+            type=int,
+            default=1,
+            help="The number of processes for the spaCy pipeline",
+        )
 
     setup_cli(extract_processes_flow, args)
@@ -1,8 +1,8 @@
 from prefect import flow
 from prefect.variables import Variable
-from prefect_sqlalchemy import SqlAlchemyConnector
 from prefect_aws import AwsCredentials
 from prefect_aws.s3 import S3Bucket
+from src.utils.db.crdb import crdb_connect, fetch_rows
 
 
 @flow
@@ -11,7 +11,7 @@ def setup_db_export():
     Setup the database export flow.
     """
     # Load the database connection
-    crdb = SqlAlchemyConnector.load("crdb-sage")
+    crdb = crdb_connect()
 
     # Load the AWS credentials
     aws = AwsCredentials.load("digitalocean-spaces")
@@ -30,5 +30,5 @@ def setup_db_export():
         credentials=aws,
     )
 
-    schedules = crdb.fetch_all("SHOW SCHEDULES")
+    schedules = fetch_rows(crdb, "SHOW SCHEDULES")
     print(schedules)
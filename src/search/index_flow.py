@@ -1,7 +1,6 @@
 from prefect import flow
 from prefect.variables import Variable
 from prefect.blocks.system import Secret
-from prefect_sqlalchemy import SqlAlchemyConnector
 import polars as pl
 import polars.selectors as cs
 import meilisearch
@@ -12,6 +11,7 @@ import copy
 
 from src.cli import setup_cli
 from src.utils.logging.loggers import get_logger
+from src.utils.db.crdb import iter_table_batches
 
 locales = ["en", "sv"]
 
@@ -42,16 +42,23 @@ def check_create_index(meili: meilisearch.Client, index_name: str, settings: dic
 
 
 def export_table(
-    crdb: SqlAlchemyConnector, table: str, cols: str = "*", schema: dict = None
+    table: str,
+    cols: str = "*",
+    schema: dict = None,
+    key: list[str] = ["id"],
+    workers: int = 1,
 ) -> pl.DataFrame:
     """
     Export a table from the database to a Polars DataFrame.
+
+    Large tables can be read in parallel key ranges with more workers.
     """
-    records = crdb.fetch_all(
-        f"SELECT {cols} FROM {table}",
+    batches = list(
+        iter_table_batches(table, cols, key=key, schema=schema, workers=workers)
     )
-    df = pl.DataFrame(records, schema_overrides=schema, orient="row")
-    return df
+    if len(batches) == 0:
+        return pl.DataFrame()
+    return pl.concat(batches, how="vertical_relaxed")
 
 
 def check_lang(lang: str):
@@ -72,7 +79,6 @@ def check_lang(lang: str):
 
 
 def index_regions(
-    crdb: SqlAlchemyConnector,
     meili: meilisearch.Client,
 ):
     """
@@ -80,7 +86,6 @@ def index_regions(
     """
     log = get_logger()
     df = export_table(
-        crdb,
         "public.regions",
         cols="id, name::string, properties::string, placetype, admin_level",
     )
@@ -101,7 +106,6 @@ def index_regions(
 
 
 def index_orgs(
-    crdb: SqlAlchemyConnector,
     meili: meilisearch.Client,
 ):
     """
@@ -109,7 +113,6 @@ def index_orgs(
     """
     log = get_logger()
     df = export_table(
-        crdb,
         "public.orgs",
         cols='id, updated_at, name, "desc"::string, avatar_url',
     )
@@ -124,7 +127,6 @@ def index_orgs(
 
 
 def index_categories(
-    crdb: SqlAlchemyConnector,
     meili: meilisearch.Client,
 ):
     """
@@ -132,7 +134,6 @@ def index_categories(
     """
     log = get_logger()
     df = export_table(
-        crdb,
         "public.categories",
         cols='id, name::string, desc_short::string, "desc"::string, image_url',
     )
@@ -152,7 +153,6 @@ def index_categories(
 
 
 def index_variants(
-    crdb: SqlAlchemyConnector,
     meili: meilisearch.Client,
 ):
     """
@@ -160,9 +160,9 @@ def index_variants(
     """
     log = get_logger()
     df = export_table(
-        crdb,
         "public.variants",
         cols='id, updated_at, name::string, "desc"::string, code',
+        workers=4,
     )
     log.info(f"Exported {df.height} rows from public.variants")
     log.info(f"Columns: {df.describe()}")
@@ -177,7 +177,6 @@ def index_variants(
 
 
 def index_components(
-    crdb: SqlAlchemyConnector,
     meili: meilisearch.Client,
 ):
     """
@@ -185,7 +184,6 @@ def index_components(
     """
     log = get_logger()
     df = export_table(
-        crdb,
         "public.components",
         cols='id, updated_at, name::string, "desc"::string',
     )
@@ -202,7 +200,6 @@ def index_components(
 
 
 def index_materials(
-    crdb: SqlAlchemyConnector,
     meili: meilisearch.Client,
 ):
     """
@@ -210,14 +207,13 @@ def index_materials(
     """
     log = get_logger()
     df = export_table(
-        crdb,
         "public.materials",
         cols='id, name::string, "desc"::string, technical',
     )
     tree_df = export_table(
-        crdb,
         "public.material_tree",
         cols="ancestor_id, descendant_id, depth",
+        key=["ancestor_id", "descendant_id"],
     )
     log.info(f"Exported {df.height} rows from public.materials")
     log.info(f"Columns: {df.describe()}")
@@ -246,7 +242,6 @@ def index_materials(
 
 
 def index_places(
-    crdb: SqlAlchemyConnector,
     meili: meilisearch.Client,
 ):
     """
@@ -254,9 +249,9 @@ def index_places(
     """
     log = get_logger()
     df = export_table(
-        crdb,
         "public.places",
         cols='id, updated_at, name::string, address::string, "desc"::string, st_asgeojson(location) as location',
+        workers=4,
     )
     log.info(f"Exported {df.height} rows from public.places")
     log.info(f"Columns: {df.describe()}")
@@ -286,7 +281,6 @@ def search_index_import(index: list[str], clear: bool, **kwargs):
     Import all database data into Meilisearch indexes.
     """
     log = get_logger()
-    crdb = SqlAlchemyConnector.load("crdb-sage")
 
     # Connect to Meilisearch
     try:
@@ -318,7 +312,7 @@ def search_index_import(index: list[str], clear: bool, **kwargs):
                     "sortableAttributes": ["admin_level"],
                 },
             )
-        index_regions(crdb, meili)
+        index_regions(meili)
     if not index or "orgs" in index:
         # Org index
         if clear:
@@ -329,7 +323,7 @@ def search_index_import(index: list[str], clear: bool, **kwargs):
             check_create_index(
                 meili, "orgs", {"searchableAttributes": ["name", "desc"]}
             )
-        index_orgs(crdb, meili)
+        index_orgs(meili)
     if not index or "categories" in index:
         # Category index
         if clear:
@@ -342,14 +336,14 @@ def search_index_import(index: list[str], clear: bool, **kwargs):
                 "categories",
                 {"searchableAttributes": ["name", "desc_short", "desc"]},
             )
-        index_categories(crdb, meili)
+        index_categories(meili)
     if not index or "items" in index:
         # Item index
         if "items" not in index_uids:
             check_create_index(
                 meili, "items", {"searchableAttributes": ["name", "desc"]}
             )
-        # index_items(crdb, meili)
+        # index_items(meili)
     if not index or "variants" in index:
         # Variant index
         if clear:
@@ -360,14 +354,14 @@ def search_index_import(index: list[str], clear: bool, **kwargs):
             check_create_index(
                 meili, "variants", {"searchableAttributes": ["name", "desc", "code"]}
             )
-        index_variants(crdb, meili)
+        index_variants(meili)
     if not index or "components" in index:
         # Component index
         if "components" not in index_uids:
             check_create_index(
                 meili, "components", {"searchableAttributes": ["name", "desc"]}
             )
-        index_components(crdb, meili)
+        index_components(meili)
     if not index or "materials" in index:
         # Material index
         if clear:
@@ -380,7 +374,7 @@ def search_index_import(index: list[str], clear: bool, **kwargs):
                 "materials",
                 {"searchableAttributes": ["name", "desc", "technical_descendants"]},
             )
-        index_materials(crdb, meili)
+        index_materials(meili)
     if not index or "places" in index:
         # Place index
         if clear:
@@ -396,7 +390,7 @@ def search_index_import(index: list[str], clear: bool, **kwargs):
                     "filterableAttributes": ["_geo"],
                 },
             )
-        index_places(crdb, meili)
+        index_places(meili)
 
 
 if __name__ == "__main__":
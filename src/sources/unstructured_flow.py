@@ -1,37 +1,200 @@
-from prefect import flow, task
+from prefect import flow
 from prefect.variables import Variable
 from prefect_aws import AwsCredentials, S3Bucket
 from unstructured.partition.auto import partition
+from unstructured.__version__ import __version__ as unstructured_version
 from unstructured.documents.elements import Element
 from unstructured.staging.base import (
     elements_to_json,
     _fix_metadata_field_precision,
     elements_to_dicts,
 )
+import gzip
+import hashlib
+import httpx
+import io
 import json
-import fasttext
+import multiprocessing
 import os
+from urllib.parse import urlparse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 
-from src.graphql.api_client.client import UpdateSourceInput
+from src.graphql.api_client.client import Client, UpdateSourceInput
+from src.graphql.api_client.get_source import GetSourceSource
 from src.cli import setup_cli
 from src.utils.api import api_connect
+from src.utils.db.crdb import crdb_connect, fetch_rows
 from src.utils.logging.loggers import get_logger
+from src.utils.lang import detect_languages
 
 
-@task
-def detect_language(text: str) -> str:
+PARTITION_OPTIONS = {
+    "detect_language_per_element": True,
+    "extract_images_in_pdf": False,
+    "skip_infer_table_types": ["jpg", "png", "heic"],
+}
+
+
+def partition_cache_key(content: bytes) -> str:
+    """
+    Hash a document with the Unstructured version and partition options.
+    """
+    h = hashlib.sha256(content)
+    h.update(unstructured_version.encode())
+    h.update(json.dumps(PARTITION_OPTIONS, sort_keys=True).encode())
+    return h.hexdigest()
+
+
+def partition_source(
+    location: str, temp_dir: str, content_file: str, compress: bool = True
+) -> tuple[list[dict] | None, list[str]]:
     """
-    Detects the language of the given text using FastText.
+    Partition a document and detect the languages of its longer elements.
+
+    Runs in a worker process and writes the elements with `write_elements`,
+    so large documents are not sent back to the parent. Results are cached
+    under the cache dir by the hash of the document, so unchanged documents
+    are not partitioned again.
+
+    Returns:
+        tuple[list[dict] | None, list[str]]: The elements to inline, or None
+            when they were written to `content_file`, and the languages.
     """
-    model = fasttext.load_model("data/lid.176.bin")
-    predictions = model.predict(text)
-    return predictions[0][0].split("__")[-1]
+    r = httpx.get(location, follow_redirects=True, timeout=120)
+    r.raise_for_status()
+    cache_file = os.path.join(
+        temp_dir, "unstructured", "cache", f"{partition_cache_key(r.content)}.json.gz"
+    )
+    if os.path.exists(cache_file):
+        with gzip.open(cache_file, "rt", encoding="utf-8") as f:
+            cached = json.load(f)
+        inline = write_elements(cached["elements"], content_file, compress)
+        return inline, cached["langs"]
+
+    partitions: list[Element] = partition(
+        file=io.BytesIO(r.content),
+        content_type=r.headers.get("content-type", "").split(";")[0] or None,
+        metadata_filename=os.path.basename(urlparse(location).path) or None,
+        **PARTITION_OPTIONS,
+    )
+    langs = []
+    texts = [p.text for p in partitions if p.text and len(p.text) > 100]
+    try:
+        for lang in detect_languages(texts):
+            if lang not in langs:
+                langs.append(lang)
+    except Exception as e:
+        get_logger().error(f"Error detecting language: {e}")
+    precision_adjusted_elements = _fix_metadata_field_precision(partitions)
+    element_dicts = elements_to_dicts(precision_adjusted_elements)
+
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    part_file = f"{cache_file}.{os.getpid()}.part"
+    with gzip.open(part_file, "wt", encoding="utf-8") as f:
+        json.dump({"elements": element_dicts, "langs": langs}, f, ensure_ascii=False)
+    os.replace(part_file, cache_file)
+    return write_elements(element_dicts, content_file, compress), langs
+
+
+INLINE_CONTENT_SIZE = 200_000
+
+
+def write_elements(
+    element_dicts: list[dict], path: str, compress: bool = True
+) -> list[dict] | None:
+    """
+    Serialise elements one per line, spilling to an NDJSON file when large.
+
+    Lines are buffered until they pass INLINE_CONTENT_SIZE bytes. Small
+    outputs are returned to be inlined in the source content, larger ones
+    are streamed to `path` (gzipped if `compress`) and None is returned.
+    The elements themselves are already in memory, so peak memory is still
+    proportional to the document, but no full JSON string is built.
+    """
+    lines = []
+    size = 0
+    f = None
+    try:
+        for e in element_dicts:
+            line = json.dumps(e, indent=None, sort_keys=True, ensure_ascii=False)
+            if f is None:
+                lines.append(line)
+                size += len(line) + 1
+                if size <= INLINE_CONTENT_SIZE:
+                    continue
+                f = (
+                    gzip.open(path, "wt", encoding="utf-8")
+                    if compress
+                    else open(path, "w", encoding="utf-8")
+                )
+                f.writelines(b + "\n" for b in lines)
+                lines = None
+            else:
+                f.write(line + "\n")
+    finally:
+        if f is not None:
+            f.close()
+    if f is not None:
+        return None
+    return element_dicts
+
+
+def store_source(
+    client: Client,
+    s3: S3Bucket,
+    bucket: str,
+    source: GetSourceSource,
+    inline: list[dict] | None,
+    langs: list[str],
+    content_file: str,
+    compress: bool = True,
+):
+    """
+    Upload the partitioned elements of a source and update it through the API.
+
+    The elements are inlined in the source content, or uploaded from
+    `content_file` when `inline` is None.
+    """
+    log = get_logger()
+
+    log.info(f"Detected languages for {source.id}: {langs}")
+    update_source = UpdateSourceInput(id=source.id)
+    if inline is None:
+        extra_args = {"ACL": "public-read", "ContentType": "application/x-ndjson"}
+        if compress:
+            extra_args["ContentEncoding"] = "gzip"
+        # Large files are sent as a multipart upload by boto3
+        s3.upload_from_path(
+            from_path=content_file,
+            to_path=f"{source.id}_content.ndjson",
+            ExtraArgs=extra_args,
+        )
+        os.remove(content_file)
+        update_source.content_url = f"https://{bucket}.fra1.cdn.digitaloceanspaces.com/{source.id}_content.ndjson"
+    else:
+        update_source.content = {"unstructured": inline}
+    if not source.metadata:
+        source.metadata = {}
+    source.metadata["languages"] = langs
+    update_source.metadata = source.metadata
+    client.update_source(update_source)
+    client.mark_source_processed(source.id)
+    log.info(f"Updated source {source.id} with Unstructured data.")
 
 
 @flow
-def source_unstructured(source_id: list[str], **kwargs):
+def source_unstructured(
+    source_id: list[str] = [],
+    unprocessed: bool = False,
+    workers: int = 4,
+    compress: bool = True,
+    **kwargs,
+):
     """
-    Processes a source using the Unstructured library.
+    Processes sources using the Unstructured library.
+
+    Documents are partitioned in a process pool and the results are uploaded
+    from a thread pool, sharing one API client and S3 session.
     """
     log = get_logger()
 
@@ -59,56 +222,84 @@ def source_unstructured(source_id: list[str], **kwargs):
     if not os.path.exists(os.path.join(temp_dir, "unstructured")):
         os.makedirs(os.path.join(temp_dir, "unstructured"))
 
+    if unprocessed:
+        crdb = crdb_connect()
+        rows = fetch_rows(
+            crdb,
+            """
+            SELECT id FROM public.sources
+            WHERE processed_at IS NULL AND location IS NOT NULL
+            ORDER BY id
+            """,
+        )
+        source_id = list(source_id) + [r[0] for r in rows]
     if len(source_id) == 0:
         raise ValueError("No source id provided")
-    op = client.get_source(source_id[0])
-    if not op:
-        raise ValueError(f"Source {source_id[0]} not found")
-    source = op.get_source
-    partitions: list[Element] = None
-    langs = []
-    if source.location:
-        partitions = partition(
-            url=source.location,
-            detect_language_per_element=True,
-            extract_images_in_pdf=False,
-            skip_infer_table_types=["jpg", "png", "heic"],
-        )
-    for p in partitions:
-        if p.text and len(p.text) > 100:
+
+    sources = []
+    for sid in dict.fromkeys(source_id):
+        op = client.get_source(sid)
+        if not op or not op.get_source:
+            raise ValueError(f"Source {sid} not found")
+        if not op.get_source.location:
+            log.warning(f"Source {sid} has no location, skipping.")
+            continue
+        sources.append(op.get_source)
+    log.info(f"Processing {len(sources)} sources")
+
+    failed = []
+    with (
+        ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+        ) as pool,
+        ThreadPoolExecutor(max_workers=workers) as uploads,
+    ):
+        content_files = {
+            source.id: os.path.join(
+                temp_dir, "unstructured", f"{source.id}_content.ndjson"
+            )
+            for source in sources
+        }
+        partitioned = {
+            pool.submit(
+                partition_source,
+                source.location,
+                temp_dir,
+                content_files[source.id],
+                compress,
+            ): source
+            for source in sources
+        }
+        stored = {}
+        for f in as_completed(partitioned):
+            source = partitioned[f]
             try:
-                lang = detect_language(p.text)
-                if lang not in langs:
-                    langs.append(lang)
-                    log.info(f"Detected language: {lang}")
+                inline, langs = f.result()
             except Exception as e:
-                log.error(f"Error detecting language: {e}")
-    precision_adjusted_elements = _fix_metadata_field_precision(partitions)
-    element_dicts = elements_to_dicts(precision_adjusted_elements)
-    elem_json = json.dumps(
-        element_dicts, indent=None, sort_keys=True, ensure_ascii=False
-    )
-    update_source = UpdateSourceInput(id=source.id)
-    if len(elem_json) > 200_000:
-        temp_file = os.path.join(temp_dir, "unstructured", f"{source.id}_content.json")
-        with open(temp_file, "w") as f:
-            f.write(elem_json)
-        s3.upload_from_path(
-            from_path=temp_file,
-            to_path=f"{source.id}_content.json",
-            ExtraArgs={"ACL": "public-read"},
-        )
-        update_source.content_url = (
-            f"https://{bucket}.fra1.cdn.digitaloceanspaces.com/{source.id}_content.json"
-        )
-    else:
-        update_source.content = {"unstructured": json.loads(elem_json)}
-    if not source.metadata:
-        source.metadata = {}
-    source.metadata["languages"] = langs
-    update_source.metadata = source.metadata
-    op = client.update_source(update_source)
-    log.info(f"Updated source {source_id[0]} with Unstructured data.")
+                log.error(f"Failed to partition source {source.id}: {e}")
+                failed.append(source.id)
+                continue
+            stored[
+                uploads.submit(
+                    store_source,
+                    client,
+                    s3,
+                    bucket,
+                    source,
+                    inline,
+                    langs,
+                    content_files[source.id],
+                    compress,
+                )
+            ] = source
+        for f in as_completed(stored):
+            try:
+                f.result()
+            except Exception as e:
+                log.error(f"Failed to update source {stored[f].id}: {e}")
+                failed.append(stored[f].id)
+    if len(failed) > 0:
+        raise RuntimeError(f"Failed to process {len(failed)} sources: {failed}")
 
 
 if __name__ == "__main__":
@@ -117,8 +308,20 @@ if __name__ == "__main__":
         parser.add_argument(
             "source_id",
             type=str,
-            nargs="+",
+            nargs="*",
             help="The source ID to process.",
         )
+        parser.add_argument(
+            "--unprocessed",
+            action="store_true",
+            default=False,
+            help="Also process all sources that have not been processed yet",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=4,
+            help="The number of documents to partition in parallel",
+        )
 
     setup_cli(source_unstructured, args)
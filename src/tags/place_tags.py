@@ -24,4 +24,59 @@ tags = [
         "image": "icon://mdi:clock",
         "tag_id": "opening_hours",
     },
+    {
+        "id": "vHVLN-FYUrBnEmoskga5Z",
+        "name": {"en": "Recycling", "sv": "Återvinning"},
+        "type": "PLACE",
+        "desc": {
+            "en": "Materials that are accepted or rejected for recycling at this place.",
+            "sv": "Material som tas emot eller inte tas emot för återvinning på denna plats.",
+        },
+        "meta_template": {
+            "schema": "schemas/place_recycling.json",
+            "uischema": "ui_schemas/place_recycling.json",
+        },
+        "bg_color": "#2E8B57",
+        "image": "icon://mdi:recycle",
+        "tag_id": "recycling",
+    },
+    {
+        "id": "rtfXExtnMj6MuJSkcsw4i",
+        "name": {"en": "Fee", "sv": "Avgift"},
+        "type": "PLACE",
+        "desc": None,
+        "meta_template": {
+            "schema": "schemas/place_fee.json",
+            "uischema": "ui_schemas/place_fee.json",
+        },
+        "bg_color": "#E0A458",
+        "image": "icon://mdi:cash",
+        "tag_id": "fee",
+    },
+    {
+        "id": "V06Zesf2qyYr1vr_ST_gh",
+        "name": {"en": "Operator", "sv": "Operatör"},
+        "type": "PLACE",
+        "desc": None,
+        "meta_template": {
+            "schema": "schemas/place_operator.json",
+            "uischema": "ui_schemas/place_operator.json",
+        },
+        "bg_color": "#5C80BC",
+        "image": "icon://mdi:domain",
+        "tag_id": "operator",
+    },
+    {
+        "id": "c6bOL8x90_16VB5GUWAQV",
+        "name": {"en": "Website", "sv": "Webbplats"},
+        "type": "PLACE",
+        "desc": None,
+        "meta_template": {
+            "schema": "schemas/place_website.json",
+            "uischema": "ui_schemas/place_website.json",
+        },
+        "bg_color": "#4D9DE0",
+        "image": "icon://mdi:web",
+        "tag_id": "website",
+    },
 ]
@@ -1,11 +1,11 @@
 from prefect import flow
-from prefect_sqlalchemy import SqlAlchemyConnector
 import json
 from jsonschema import Draft202012Validator
 
 import src.tags.variant_tags as variant_tags
 import src.tags.component_tags as component_tags
 import src.tags.place_tags as place_tags
+from src.utils.db.crdb import crdb_connect
 
 
 @flow
@@ -13,7 +13,7 @@ def update_db_tags():
     """
     Flow to update the tags table with predefined tags.
     """
-    crdb = SqlAlchemyConnector.load("crdb-sage")
+    crdb = crdb_connect()
 
     all_tags = []
     for tags in [variant_tags.tags, component_tags.tags, place_tags.tags]:
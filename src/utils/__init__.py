@@ -1,5 +1,11 @@
+import json
 import os
 import re
+import hashlib
+import threading
+import time
+import httpx
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse
 from prefect.variables import Variable
 from prefect_aws import AwsCredentials, S3Bucket
@@ -78,8 +84,8 @@ def download_cache_file(basepath_var: str, url: str, subdir: str = "") -> str:
             s3_bucket.download_object_to_path(baseparsed.path, localpath)
         except Exception:
             log.info(f"File {localpath} not found in S3, downloading from {url}.")
-            if not os.path.exists(localpath):
-                os.system(f"curl -o {localpath} {url}")
+            if not verify_file(localpath):
+                download_file(url, localpath)
             else:
                 log.info(f"File {localpath} already exists, skipping download.")
             uploadpath = s3_bucket.upload_from_path(
@@ -92,15 +98,271 @@ def download_cache_file(basepath_var: str, url: str, subdir: str = "") -> str:
             basepath = os.path.join(os.getcwd(), basepath)
         filepath = os.path.join(basepath, filename)
 
-        if not os.path.exists(filepath):
+        if not verify_file(filepath):
             log.info(f"Downloading {url} to {filepath}")
-            os.system(f"curl -o {filepath} {url}")
+            download_file(url, filepath)
         else:
             log.info(f"File {filepath} already exists, skipping download.")
 
     return filepath
 
 
+def file_sha256(filepath: str, chunk_size: int = 1024 * 1024) -> str:
+    """
+    Compute the SHA-256 checksum of a file, reading it in fixed-size chunks.
+    """
+    sha = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        while chunk := f.read(chunk_size):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+DOWNLOAD_SEGMENT_SIZE = 64 * 1024 * 1024
+DOWNLOAD_RETRIES = 3
+
+_http_client: httpx.Client = None
+_http_lock = threading.Lock()
+
+
+def http_client() -> httpx.Client:
+    """
+    Get the HTTP client shared by all downloads in this process.
+
+    Its connection pool is bounded, so concurrent downloads of several
+    datasets wait for a free connection instead of opening more.
+    """
+    global _http_client
+    with _http_lock:
+        if _http_client is None:
+            _http_client = httpx.Client(
+                follow_redirects=True,
+                timeout=httpx.Timeout(60, pool=None),
+                limits=httpx.Limits(max_connections=16, max_keepalive_connections=8),
+            )
+        return _http_client
+
+
+class DownloadProgress:
+    """
+    The bytes downloaded per segment of a file, saved next to it so an
+    interrupted download resumes where it stopped.
+    """
+
+    def __init__(self, path: str, etag: str, size: int):
+        self.path = path
+        self.lock = threading.Lock()
+        self.state = {"etag": etag, "size": size, "done": {}}
+        self.resumed = False
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                state = json.load(f)
+            if state.get("etag") == etag and state.get("size") == size:
+                self.state = state
+                self.resumed = True
+
+    def done(self, start: int) -> int:
+        with self.lock:
+            return self.state["done"].get(str(start), 0)
+
+    def update(self, start: int, done: int):
+        with self.lock:
+            self.state["done"][str(start)] = done
+            with open(self.path + ".tmp", "w") as f:
+                json.dump(self.state, f)
+            os.replace(self.path + ".tmp", self.path)
+
+
+def download_segment(
+    url: str,
+    path: str,
+    start: int,
+    end: int,
+    chunk_size: int,
+    etag: str = None,
+    progress: DownloadProgress = None,
+):
+    """
+    Download the byte range start-end (inclusive) of a URL into a file.
+
+    The bytes are written at their offset in the preallocated file. Resumes
+    from the bytes recorded in `progress` and retries with backoff.
+    """
+    client = http_client()
+    length = end - start + 1
+    done = progress.done(start) if progress is not None else 0
+    for attempt in range(DOWNLOAD_RETRIES):
+        if done >= length:
+            return
+        headers = {"Range": f"bytes={start + done}-{end}"}
+        if etag and not etag.startswith("W/"):
+            headers["If-Range"] = etag
+        try:
+            with client.stream("GET", url, headers=headers) as r:
+                if r.status_code != 206:
+                    raise ValueError(
+                        f"Range request for {url} returned {r.status_code}"
+                    )
+                with open(path, "r+b") as f:
+                    f.seek(start + done)
+                    for chunk in r.iter_bytes(chunk_size):
+                        chunk = chunk[: length - done]
+                        f.write(chunk)
+                        done += len(chunk)
+                        if progress is not None:
+                            # Only record bytes that reached the file
+                            f.flush()
+                            progress.update(start, done)
+            if done == length:
+                return
+        except (httpx.HTTPError, ValueError):
+            if attempt == DOWNLOAD_RETRIES - 1:
+                raise
+        time.sleep(2**attempt)
+    raise ValueError(f"Download of {url} bytes {start}-{end} is incomplete")
+
+
+def download_file(
+    url: str,
+    filepath: str,
+    chunk_size: int = 1024 * 1024,
+    workers: int = 4,
+    sha256: str = None,
+) -> str:
+    """
+    Download a file from a URL to disk.
+
+    When the server supports range requests, the file is fetched in
+    DOWNLOAD_SEGMENT_SIZE segments, several at a time, each written at its
+    offset in one preallocated file. The progress of every segment is kept
+    on disk so an interrupted download resumes where it stopped. The ETag is
+    sent with every range request so segments of a changed file are not
+    mixed. Otherwise the file is streamed in one request.
+
+    The file is only renamed into place once its size matches, the ETag or
+    given checksum verifies, and the SHA-256 checksum is stored next to it,
+    so partial downloads are never treated as cached.
+
+    Returns:
+        str: The SHA-256 checksum of the downloaded file.
+    """
+    log = get_logger()
+
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    tmp_path = filepath + ".part"
+    client = http_client()
+    head = client.head(url)
+    headers = head.headers if head.is_success else {}
+    size = None
+    if "Content-Length" in headers and "Content-Encoding" not in headers:
+        size = int(headers["Content-Length"])
+    etag = headers.get("ETag")
+    ranged = headers.get("Accept-Ranges") == "bytes" and size is not None
+
+    sha = hashlib.sha256()
+    md5 = hashlib.md5()
+    if ranged:
+        # Start over when the file changed or the partial file is gone
+        progress_path = filepath + ".progress"
+        progress = DownloadProgress(progress_path, etag or "", size)
+        if not (
+            progress.resumed
+            and os.path.exists(tmp_path)
+            and os.path.getsize(tmp_path) == size
+        ):
+            progress.state["done"] = {}
+            with open(tmp_path, "wb") as f:
+                f.truncate(size)
+
+        segments = [
+            (start, min(start + DOWNLOAD_SEGMENT_SIZE, size) - 1)
+            for start in range(0, size, DOWNLOAD_SEGMENT_SIZE)
+        ]
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [
+                pool.submit(
+                    download_segment,
+                    url,
+                    tmp_path,
+                    start,
+                    end,
+                    chunk_size,
+                    etag,
+                    progress,
+                )
+                for start, end in segments
+            ]
+            for f in futures:
+                f.result()
+        with open(tmp_path, "rb") as f:
+            while chunk := f.read(chunk_size):
+                sha.update(chunk)
+                md5.update(chunk)
+        downloaded = sum(progress.done(start) for start, _ in segments)
+        if os.path.exists(progress_path):
+            os.remove(progress_path)
+    else:
+        downloaded = 0
+        with client.stream("GET", url) as r:
+            r.raise_for_status()
+            with open(tmp_path, "wb") as f:
+                for chunk in r.iter_bytes(chunk_size):
+                    f.write(chunk)
+                    sha.update(chunk)
+                    md5.update(chunk)
+                    downloaded += len(chunk)
+
+    checksum = sha.hexdigest()
+    error = None
+    if size is not None and downloaded != size:
+        error = f"Download of {url} is incomplete: {downloaded}/{size} bytes"
+    elif sha256 is not None and checksum != sha256:
+        error = f"Checksum of {url} does not match: {checksum} != {sha256}"
+    elif etag and re.fullmatch(r'"[0-9a-f]{32}"', etag):
+        # Single part S3 style ETags are the MD5 of the content
+        if etag.strip('"') != md5.hexdigest():
+            error = f"ETag of {url} does not match: {md5.hexdigest()} != {etag}"
+    if error is not None:
+        os.remove(tmp_path)
+        raise ValueError(error)
+
+    os.replace(tmp_path, filepath)
+    write_checksum(filepath, checksum)
+    log.info(f"Downloaded {downloaded} bytes from {url} to {filepath}")
+    return checksum
+
+
+def write_checksum(filepath: str, checksum: str = None):
+    """
+    Store the SHA-256 checksum, size and mtime of a file next to it.
+
+    Call this whenever a cached file is written, hashing it if no checksum
+    is given.
+    """
+    if checksum is None:
+        checksum = file_sha256(filepath)
+    stat = os.stat(filepath)
+    with open(filepath + ".sha256", "w") as f:
+        f.write(f"{checksum} {stat.st_size} {stat.st_mtime_ns}")
+
+
+def verify_file(filepath: str, full: bool = False) -> bool:
+    """
+    Check that a cached file exists and is the one its checksum was stored for.
+
+    By default only the size and mtime are compared, so large files are not
+    re-hashed on every run. With `full`, the SHA-256 checksum is compared.
+    """
+    if not os.path.exists(filepath) or not os.path.exists(filepath + ".sha256"):
+        return False
+    with open(filepath + ".sha256", "r") as f:
+        parts = f.read().split()
+    if len(parts) == 3 and not full:
+        stat = os.stat(filepath)
+        return [str(stat.st_size), str(stat.st_mtime_ns)] == parts[1:]
+    return len(parts) > 0 and file_sha256(filepath) == parts[0]
+
+
 def slugify(s):
     s = s.lower().strip()
     s = re.sub(r"[^\w\s-]", "", s)
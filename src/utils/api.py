@@ -6,6 +6,7 @@ from http import cookies
 from urllib.parse import unquote
 
 from src.graphql.api_client.client import Client
+from src.utils.db.crdb import crdb_connect, fetch_row
 
 
 def api_connect(crdb: SqlAlchemyConnector = None):
@@ -13,12 +14,13 @@ def api_connect(crdb: SqlAlchemyConnector = None):
     Connects to the API and returns the client and user.
     """
     if crdb is None:
-        crdb = SqlAlchemyConnector.load("crdb-sage")
+        crdb = crdb_connect()
     # Load the databot
-    user = crdb.fetch_one(
+    user = fetch_row(
+        crdb,
         "SELECT * FROM public.users WHERE email = 'databot@sageleaf.app'",
     )
-    if len(user) == 0:
+    if user is None or len(user) == 0:
         raise ValueError("No databot user found in the database.")
     # Create an API client
     api_url = Variable.get("api_url")
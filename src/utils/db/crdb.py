@@ -1,9 +1,18 @@
+import io
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from prefect.variables import Variable
 from prefect.blocks.system import Secret
 from prefect_sqlalchemy import SqlAlchemyConnector
 import polars as pl
+from psycopg2 import OperationalError
+from psycopg2.pool import ThreadedConnectionPool
+from sqlalchemy import Engine, text
+from sqlalchemy.pool import QueuePool
 from src.utils import is_production
+from src.utils.logging.loggers import get_logger
 
 
 def create_polars_uri(conn: SqlAlchemyConnector):
@@ -36,16 +45,141 @@ def create_polars_uri(conn: SqlAlchemyConnector):
     return conn_str
 
 
+POOL_SIZE = 8
+
+_connectors: dict[str, SqlAlchemyConnector] = {}
+_uris: dict[str, str] = {}
+_copy_pools: dict[str, ThreadedConnectionPool] = {}
+_connect_lock = threading.RLock()
+
+
+def crdb_connect(conn: str = "crdb-sage") -> SqlAlchemyConnector:
+    """
+    Load a SqlAlchemyConnector block once per process and share it.
+
+    The engine keeps a pool of open connections, so repeated queries don't
+    pay for a new handshake. Read with `fetch_rows`/`fetch_row` rather than
+    the connector's `fetch_*` methods, which keep every result set and its
+    connection checked out until `reset_connections()`.
+    """
+    with _connect_lock:
+        if conn not in _connectors:
+            crdb = SqlAlchemyConnector.load(conn)
+            crdb.get_engine(
+                poolclass=QueuePool,
+                pool_size=POOL_SIZE,
+                max_overflow=POOL_SIZE,
+                pool_pre_ping=True,
+                pool_recycle=1800,
+            )
+            _connectors[conn] = crdb
+        return _connectors[conn]
+
+
+def crdb_uri(conn: str = "crdb-sage") -> str:
+    """
+    Get the cached connection string for a SqlAlchemyConnector block.
+    """
+    with _connect_lock:
+        if conn not in _uris:
+            _uris[conn] = create_polars_uri(crdb_connect(conn))
+        return _uris[conn]
+
+
+def crdb_copy_pool(conn: str = "crdb-sage") -> ThreadedConnectionPool:
+    """
+    Get the shared pool of raw psycopg2 connections used for COPY loads.
+    """
+    with _connect_lock:
+        if conn not in _copy_pools:
+            _copy_pools[conn] = ThreadedConnectionPool(1, POOL_SIZE, crdb_uri(conn))
+        return _copy_pools[conn]
+
+
+def fetch_rows(crdb: SqlAlchemyConnector, sql: str, params: dict = None) -> list:
+    """
+    Run a query and return all rows, giving the connection back to the pool.
+    """
+    with crdb.get_engine().connect() as c:
+        return c.execute(text(sql), params or {}).fetchall()
+
+
+def fetch_row(crdb: SqlAlchemyConnector, sql: str, params: dict = None):
+    """
+    Run a query and return its first row, giving the connection back to the pool.
+    """
+    with crdb.get_engine().connect() as c:
+        return c.execute(text(sql), params or {}).fetchone()
+
+
+def crdb_column_type(dtype: pl.DataType) -> str:
+    """
+    Map a Polars data type to the CRDB column type used in load tables.
+    """
+    if dtype.is_integer():
+        return "INT8"
+    if dtype.is_float():
+        return "FLOAT8"
+    if dtype == pl.Boolean:
+        return "BOOL"
+    if isinstance(dtype, pl.Datetime):
+        return "TIMESTAMPTZ" if dtype.time_zone else "TIMESTAMP"
+    if dtype == pl.Date:
+        return "DATE"
+    return "STRING"
+
+
+def copy_chunk(pool: ThreadedConnectionPool, table: str, df: pl.DataFrame):
+    """
+    Stream a DataFrame chunk into a table with COPY FROM STDIN as CSV.
+    """
+    buf = io.BytesIO()
+    df.write_csv(buf, include_header=False)
+    cols = ", ".join(f'"{c}"' for c in df.columns)
+    # Pooled connections may have been dropped by the server during a long
+    # flow, so a dead one is discarded and the chunk retried once
+    for attempt in range(2):
+        conn = pool.getconn()
+        if conn.closed:
+            pool.putconn(conn, close=True)
+            conn = pool.getconn()
+        try:
+            buf.seek(0)
+            with conn.cursor() as cur:
+                cur.copy_expert(f"COPY {table} ({cols}) FROM STDIN WITH CSV", buf)
+            conn.commit()
+        except OperationalError:
+            if conn.closed and attempt == 0:
+                pool.putconn(conn, close=True)
+                continue
+            if not conn.closed:
+                conn.rollback()
+            pool.putconn(conn, close=bool(conn.closed))
+            raise
+        except Exception:
+            conn.rollback()
+            pool.putconn(conn)
+            raise
+        pool.putconn(conn)
+        return
+
+
 def db_write_dataframe(
-    df: pl.DataFrame, table: str, id_cols: list[str] = ["id"], conn: str = "crdb-sage"
+    df: pl.DataFrame,
+    table: str,
+    id_cols: list[str] = ["id"],
+    conn: str = "crdb-sage",
+    workers: int = 4,
 ):
     """
     Write a Polars DataFrame to a CRDB database table using the crdb-sage SqlAlchemyConnector.
 
-    Converts struct columns to JSONB format.
+    Converts struct columns to JSONB format. The table is created with its
+    primary key in place and the rows are streamed with COPY in chunks,
+    spread over several connections.
     """
-    crdb = SqlAlchemyConnector.load(conn)
-    conn = create_polars_uri(crdb)
+    crdb = crdb_connect(conn)
+    pool = crdb_copy_pool(conn)
 
     # Convert struct columns to JSONB format
     for col in df.columns:
@@ -58,33 +192,329 @@ def db_write_dataframe(
             # The actual list value will be under the JSON key with the same name as the column
             df = df.with_columns(pl.struct(pl.col(col)).struct.json_encode().alias(col))
 
+    col_defs = []
+    for col, dtype in df.schema.items():
+        not_null = " NOT NULL" if col in id_cols else ""
+        col_defs.append(f'"{col}" {crdb_column_type(dtype)}{not_null}')
+    crdb.execute(f"DROP TABLE IF EXISTS databot.{table};")
+    crdb.execute(
+        f"CREATE TABLE databot.{table} ({', '.join(col_defs)}, "
+        + f"PRIMARY KEY ({','.join(id_cols)}));"
+    )
+
     CHUNK_SIZE = 50_000
-    if df.height > CHUNK_SIZE:
-        # If the dataframe is too large, write it in chunks
-        df.slice(0, CHUNK_SIZE).write_database(
-            connection=conn,
-            table_name=f"databot.{table}",
-            if_table_exists="replace",
-            engine="adbc",
+    chunks = [df.slice(i, CHUNK_SIZE) for i in range(0, df.height, CHUNK_SIZE)]
+    with ThreadPoolExecutor(max_workers=min(workers, POOL_SIZE)) as executor:
+        futures = [
+            executor.submit(copy_chunk, pool, f"databot.{table}", chunk)
+            for chunk in chunks
+        ]
+        for f in futures:
+            f.result()
+
+
+def is_retryable(e: Exception) -> bool:
+    """
+    Check if an error is a CRDB transaction restart that can be retried.
+    """
+    orig = getattr(e, "orig", e)
+    return getattr(orig, "pgcode", None) == "40001"
+
+
+def execute_with_retry(
+    crdb: SqlAlchemyConnector, sql: str, params: dict = None, retries: int = 5
+):
+    """
+    Execute a statement, retrying with backoff on CRDB transaction restarts.
+    """
+    for attempt in range(retries):
+        try:
+            return crdb.execute(sql, params)
+        except Exception as e:
+            if not is_retryable(e) or attempt == retries - 1:
+                raise
+            time.sleep(0.1 * 2**attempt)
+
+
+def load_table_ranges(
+    crdb: SqlAlchemyConnector,
+    load_table: str,
+    key: list[str] = ["id"],
+    batch_size: int = 5_000,
+) -> list[tuple[str, dict]]:
+    """
+    Split a databot load table into key ranges of about batch_size rows.
+
+    Returns:
+        list[tuple[str, dict]]: The WHERE clause and its parameters for each range.
+    """
+    key_cols = ", ".join(key)
+    bounds = fetch_rows(
+        crdb,
+        f"""
+        SELECT {key_cols} FROM (
+            SELECT {key_cols}, ROW_NUMBER() OVER (ORDER BY {key_cols}) AS rn
+            FROM databot.{load_table}
+        ) WHERE rn % :batch_size = 0 ORDER BY {key_cols}
+        """,
+        {"batch_size": batch_size},
+    )
+    bounds = [tuple(row) for row in bounds] + [None]
+
+    key_row = f"({key_cols})"
+    lower_row = "(" + ", ".join(f":lower_{i}" for i in range(len(key))) + ")"
+    upper_row = "(" + ", ".join(f":upper_{i}" for i in range(len(key))) + ")"
+    ranges = []
+    lower = None
+    for upper in bounds:
+        where = []
+        params = {}
+        if lower is not None:
+            where.append(f"{key_row} > {lower_row}")
+            params.update({f"lower_{i}": v for i, v in enumerate(lower)})
+        if upper is not None:
+            where.append(f"{key_row} <= {upper_row}")
+            params.update({f"upper_{i}": v for i, v in enumerate(upper)})
+        ranges.append(
+            ("WHERE " + " AND ".join(where) if len(where) > 0 else "", params)
         )
-        for i in range(CHUNK_SIZE, df.height, CHUNK_SIZE):
-            chunk = df.slice(i, CHUNK_SIZE)
-            chunk.write_database(
-                connection=conn,
-                table_name=f"databot.{table}",
-                if_table_exists="append",
-                engine="adbc",
+        lower = upper
+    return ranges
+
+
+def staged_upsert(
+    df: pl.DataFrame,
+    table: str,
+    columns: dict[str, str],
+    key: list[str] = ["id"],
+    conflict: list[str] = None,
+    insert_only: list[str] = ["created_at"],
+    touch: list[str] = ["updated_at"],
+    load_table: str = None,
+    batch_size: int = 5_000,
+    drop: bool = True,
+    conn: str = "crdb-sage",
+):
+    """
+    Write a DataFrame to a databot load table and merge it into public.{table}.
+
+    The merge runs in batches of key ranges of the load table, each in its own
+    transaction and retried on transaction restarts, so large merges stay
+    below the transaction size limits. Existing rows are only written when one
+    of their values changed.
+
+    Args:
+        df (pl.DataFrame): The rows to merge, an Arrow table is also accepted.
+        table (str): The target table in the public schema.
+        columns (dict[str, str]): Target columns mapped to SQL expressions over the load table.
+        key (list[str]): The primary key of the load table, used for the batches.
+        conflict (list[str]): The conflict columns of the target table, defaults to key.
+        insert_only (list[str]): Columns that are not changed when a row already exists.
+        touch (list[str]): Columns that are updated but not compared for changes.
+        load_table (str): The load table name, defaults to {table}_load.
+        batch_size (int): The number of load table rows per transaction.
+        drop (bool): Drop the load table when done.
+
+    Returns:
+        dict[str, int]: The number of inserted, updated and unchanged rows.
+    """
+    log = get_logger()
+
+    if not isinstance(df, pl.DataFrame):
+        df = pl.from_arrow(df)
+    if conflict is None:
+        conflict = key
+    if load_table is None:
+        load_table = f"{table}_load"
+
+    db_write_dataframe(df, load_table, id_cols=key, conn=conn)
+    crdb = crdb_connect(conn)
+
+    ranges = load_table_ranges(crdb, load_table, key, batch_size)
+
+    updates = [c for c in columns if c not in conflict and c not in insert_only]
+    compared = [c for c in updates if c not in touch]
+    if len(updates) > 0:
+        on_conflict = "DO UPDATE SET " + ", ".join(
+            f'"{c}" = EXCLUDED."{c}"' for c in updates
+        )
+        # Skip rows where nothing but the touched columns would change
+        if len(compared) > 0:
+            on_conflict += (
+                " WHERE (" + ", ".join(f't."{c}"' for c in compared) + ")"
+                " IS DISTINCT FROM ("
+                + ", ".join(f'EXCLUDED."{c}"' for c in compared)
+                + ")"
             )
     else:
-        df.write_database(
-            connection=conn,
-            table_name=f"databot.{table}",
-            if_table_exists="replace",
-            engine="adbc",
+        on_conflict = "DO NOTHING"
+    conflict_select = ", ".join(f"{columns[c]} AS {c}" for c in conflict)
+    conflict_join = " AND ".join(f"t.{c} = s.{c}" for c in conflict)
+
+    counts = {"inserted": 0, "updated": 0, "unchanged": 0}
+    for where_sql, params in ranges:
+        total, existing = fetch_row(
+            crdb,
+            f"""
+            SELECT COUNT(*), COUNT(t.{conflict[0]}) FROM (
+                SELECT {conflict_select} FROM databot.{load_table} {where_sql}
+            ) AS s LEFT JOIN public.{table} AS t ON {conflict_join}
+            """,
+            params,
         )
+        result = execute_with_retry(
+            crdb,
+            f"""
+            INSERT INTO public.{table} AS t ({", ".join(f'"{c}"' for c in columns)})
+            SELECT {", ".join(columns.values())}
+            FROM databot.{load_table}
+            {where_sql}
+            ON CONFLICT ({", ".join(conflict)}) {on_conflict};
+            """,
+            params,
+        )
+        inserted = total - existing
+        updated = max(result.rowcount - inserted, 0)
+        counts["inserted"] += inserted
+        counts["updated"] += updated
+        counts["unchanged"] += existing - updated
 
-    for col in id_cols:
-        crdb.execute(f"ALTER TABLE databot.{table} ALTER COLUMN {col} SET NOT NULL;")
-    crdb.execute(
-        f"ALTER TABLE databot.{table} ALTER PRIMARY KEY USING COLUMNS ({','.join(id_cols)});"
+    if drop:
+        crdb.execute(f"DROP TABLE IF EXISTS databot.{load_table};")
+    log.info(
+        f"public.{table}: {counts['inserted']} inserted, {counts['updated']} updated, "
+        + f"{counts['unchanged']} unchanged"
     )
+    return counts
+
+
+def fetch_batch(
+    engine: Engine,
+    sql: str,
+    params: dict,
+    schema: dict = None,
+) -> pl.DataFrame:
+    """
+    Run a query on a pooled connection and return the rows as a DataFrame.
+    """
+    with engine.connect() as c:
+        result = c.execute(text(sql), params)
+        cols = list(result.keys())
+        rows = result.fetchall()
+    return pl.DataFrame(
+        [tuple(r) for r in rows], schema=cols, schema_overrides=schema, orient="row"
+    )
+
+
+def iter_table_batches(
+    table: str,
+    cols: str = "*",
+    key: list[str] = ["id"],
+    batch_size: int = 10_000,
+    where: str = None,
+    params: dict = None,
+    after: list = None,
+    schema: dict = None,
+    workers: int = 1,
+    conn: str = "crdb-sage",
+):
+    """
+    Read a table in key order, one DataFrame per batch.
+
+    Pages with keyset pagination on `key`, so every batch is an index range
+    scan instead of an ever growing OFFSET. With several workers the key
+    space is split into ranges that are paged concurrently, and batches are
+    yielded as each round completes, so their order is only guaranteed with
+    a single worker.
+
+    Args:
+        table (str): The table, or a FROM clause with joins.
+        cols (str): The columns to select. Must include the key columns.
+        key (list[str]): The unique key columns to page on.
+        batch_size (int): The number of rows per batch.
+        where (str): An optional filter, using bound parameters.
+        params (dict): The bound parameters for the filter.
+        after (list): Only read rows with a key after this one.
+        schema (dict): Polars schema overrides for the batches.
+        workers (int): The number of key ranges read in parallel.
+        conn (str): The SqlAlchemyConnector block name.
+    """
+    engine = crdb_connect(conn).get_engine()
+    key_cols = ", ".join(key)
+    # Qualified keys like s.id come back as plain column names
+    key_names = [k.split(".")[-1] for k in key]
+    params = dict(params or {})
+    filters = [f"({where})"] if where else []
+    if after is not None:
+        filters.append(
+            f"({key_cols}) > ({', '.join(f':after_{i}' for i in range(len(key)))})"
+        )
+        params.update({f"after_{i}": v for i, v in enumerate(after)})
+
+    # Split the key space into ranges with roughly equal row counts
+    bounds = [None]
+    if workers > 1:
+        where_sql = "WHERE " + " AND ".join(filters) if len(filters) > 0 else ""
+        with engine.connect() as c:
+            total = c.execute(
+                text(f"SELECT COUNT(*) FROM {table} {where_sql}"), params
+            ).scalar()
+            if total > batch_size:
+                step = -(-total // workers)
+                splits = c.execute(
+                    text(
+                        f"""
+                        SELECT {", ".join(key_names)} FROM (
+                            SELECT {key_cols}, ROW_NUMBER() OVER (ORDER BY {key_cols}) AS rn
+                            FROM {table} {where_sql}
+                        ) AS b WHERE rn % :step = 0 ORDER BY rn
+                        """
+                    ),
+                    {**params, "step": step},
+                ).fetchall()
+                bounds += [tuple(r) for r in splits]
+
+    def page_sql(lower: bool, upper: bool) -> str:
+        conds = list(filters)
+        if lower:
+            conds.append(
+                f"({key_cols}) > ({', '.join(f':lower_{i}' for i in range(len(key)))})"
+            )
+        if upper:
+            conds.append(
+                f"({key_cols}) <= ({', '.join(f':upper_{i}' for i in range(len(key)))})"
+            )
+        where_sql = "WHERE " + " AND ".join(conds) if len(conds) > 0 else ""
+        return (
+            f"SELECT {cols} FROM {table} {where_sql} ORDER BY {key_cols} LIMIT :limit"
+        )
+
+    # Each range tracks its cursor and upper bound
+    ranges = [
+        [bounds[i], bounds[i + 1] if i + 1 < len(bounds) else None]
+        for i in range(len(bounds))
+    ]
+
+    def next_batch(r: list) -> pl.DataFrame:
+        lower, upper = r
+        p = {**params, "limit": batch_size}
+        if lower is not None:
+            p.update({f"lower_{i}": v for i, v in enumerate(lower)})
+        if upper is not None:
+            p.update({f"upper_{i}": v for i, v in enumerate(upper)})
+        return fetch_batch(
+            engine, page_sql(lower is not None, upper is not None), p, schema
+        )
+
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, POOL_SIZE))) as executor:
+        while len(ranges) > 0:
+            batches = list(executor.map(next_batch, ranges))
+            active = []
+            for r, df in zip(ranges, batches):
+                if df.height == 0:
+                    continue
+                yield df
+                if df.height == batch_size:
+                    r[0] = df.select(key_names).row(-1)
+                    active.append(r)
+            ranges = active
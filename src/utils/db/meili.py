@@ -1,6 +1,7 @@
 from prefect.variables import Variable
 from prefect.blocks.system import Secret
 import meilisearch
+import polars as pl
 
 
 def meili_connect() -> meilisearch.Client:
@@ -17,3 +18,38 @@ def meili_connect() -> meilisearch.Client:
     if not health:
         raise ValueError("Meilisearch is not healthy or not reachable.")
     return meili
+
+
+def meili_match(
+    meili: meilisearch.Client,
+    index: str,
+    names: list[str],
+    batch_size: int = 100,
+) -> dict[str, str]:
+    """
+    Resolve names to the id of their best match in a Meilisearch index.
+
+    Names are deduplicated and sent in multi-search batches, so the number of
+    requests scales with the distinct names. Names without a hit map to None.
+    """
+    unique = list(dict.fromkeys(n for n in names if n is not None))
+    matches = {}
+    for i in range(0, len(unique), batch_size):
+        batch = unique[i : i + batch_size]
+        res = meili.multi_search(
+            [{"indexUid": index, "q": name, "limit": 1} for name in batch]
+        )
+        for name, result in zip(batch, res["results"]):
+            hits = result["hits"]
+            matches[name] = hits[0]["id"] if len(hits) > 0 else None
+    return matches
+
+
+def meili_match_column(
+    meili: meilisearch.Client, index: str, col: pl.Series
+) -> pl.Series:
+    """
+    Resolve a column of names to ids with `meili_match`.
+    """
+    matches = meili_match(meili, index, col.to_list())
+    return col.replace_strict(matches, default=None, return_dtype=pl.String)
@@ -1,20 +1,63 @@
 import json
+import re
+from typing import Any, Iterator
+from pydantic import BaseModel, ValidationError
 
+_decoder = json.JSONDecoder()
+_json_start = re.compile(r"[{\[]")
+_json_end = re.compile(r"[}\]]")
 
-def extract_any_json(s: str):
+
+def iter_json(s: str) -> Iterator[Any]:
+    """
+    Yield every top-level JSON object or array embedded in a string.
+
+    Scans the string once, decoding in place from each candidate start and
+    continuing after the end of every decoded value.
+    """
     cur = 0
-    json_list = []
-    while cur < len(s):
-        s = s[next(idx for idx, c in enumerate(s[cur:]) if c in "{[") :]
+    while True:
+        m = _json_start.search(s, cur)
+        if m is None:
+            return
         try:
-            valid = json.loads(s)
-            json_list.append(valid)
-            cur += len(s)
-        except json.JSONDecodeError as e:
+            value, cur = _decoder.raw_decode(s, m.start())
+        except json.JSONDecodeError:
+            cur = m.start() + 1
+            continue
+        except RecursionError:
+            # Too deeply nested to decode, skip the run of openers and retry
+            # from the innermost one before the next closing bracket
+            end = _json_end.search(s, m.start())
+            end = len(s) if end is None else end.start()
+            cur = max(
+                s.rfind("{", m.start() + 1, end), s.rfind("[", m.start() + 1, end)
+            )
+            cur = m.start() + 1 if cur < 0 else cur
+            continue
+        yield value
+
+
+def extract_any_json(s: str, model: type[BaseModel] = None) -> list:
+    """
+    Extract the JSON values embedded in a string, such as an LLM response.
+
+    Args:
+        s (str): The string to scan.
+        model (type[BaseModel]): Validate objects against this model. The
+            items of arrays are validated one by one, and values that fail
+            validation are skipped.
+
+    Returns:
+        list: The decoded values, or model instances when a model is given.
+    """
+    if model is None:
+        return list(iter_json(s))
+    results = []
+    for value in iter_json(s):
+        for v in value if isinstance(value, list) else [value]:
             try:
-                valid = json.loads(s[: e.pos])
-                json_list.append(valid)
-                cur += e.pos
-            except json.JSONDecodeError:
-                return json_list
-    return json_list
+                results.append(model.model_validate(v))
+            except ValidationError:
+                continue
+    return results
@@ -0,0 +1,146 @@
+import json
+import re
+import unicodedata
+import polars as pl
+
+from src.utils.db.crdb import iter_table_batches
+
+
+def normalize(text: str) -> str:
+    """
+    Lowercase a string, strip accents and collapse whitespace.
+    """
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return " ".join(text.split())
+
+
+def trigrams(text: str) -> list[str]:
+    """
+    Get the distinct trigrams of a string, with each word padded like pg_trgm.
+    """
+    grams = set()
+    for word in re.findall(r"[^\W_]+", normalize(text)):
+        w = f"  {word} "
+        grams.update(w[i : i + 3] for i in range(len(w) - 2))
+    return list(grams)
+
+
+class TrigramMatcher:
+    """
+    In-process fuzzy matcher over a vocabulary of names.
+
+    Names are indexed by their trigrams and matched with the Dice coefficient
+    of the trigram sets, computed with Polars joins so a whole column of
+    queries is resolved at once.
+    """
+
+    def __init__(self, index: pl.DataFrame):
+        """
+        Args:
+            index (pl.DataFrame): The id, name and trigram of every indexed name.
+        """
+        self.index = index
+        self.sizes = index.group_by("id", "name").agg(pl.len().alias("n"))
+
+    @classmethod
+    def from_names(cls, names: pl.DataFrame) -> "TrigramMatcher":
+        """
+        Build a matcher from a DataFrame with id and name columns.
+        """
+        names = names.select("id", "name").drop_nulls().unique()
+        index = names.with_columns(
+            pl.col("name")
+            .map_elements(trigrams, return_dtype=pl.List(pl.String))
+            .alias("trigram")
+        ).explode("trigram")
+        return cls(index)
+
+    @classmethod
+    def from_table(
+        cls,
+        table: str,
+        id_col: str = "id",
+        name_col: str = "name",
+        translations: bool = True,
+        conn: str = "crdb-sage",
+    ) -> "TrigramMatcher":
+        """
+        Build a matcher from every translation in a multilingual name column,
+        or from a plain string column when `translations` is False.
+        """
+        rows = []
+        for df in iter_table_batches(
+            table, f"{id_col} AS id, {name_col}::STRING AS name", conn=conn
+        ):
+            for row_id, name in df.iter_rows():
+                if name is None:
+                    continue
+                texts = json.loads(name).values() if translations else [name]
+                for text in texts:
+                    if isinstance(text, str) and text != "":
+                        rows.append((row_id, text))
+        names = pl.DataFrame(
+            rows, schema={"id": pl.String, "name": pl.String}, orient="row"
+        )
+        return cls.from_names(names)
+
+    @classmethod
+    def load(cls, path: str) -> "TrigramMatcher":
+        """
+        Load a matcher saved with `save`.
+        """
+        return cls(pl.read_parquet(path))
+
+    def save(self, path: str):
+        """
+        Save the trigram index to a Parquet file.
+        """
+        self.index.write_parquet(path)
+
+    def match(
+        self, queries: list[str], k: int = 1, threshold: float = 0.3
+    ) -> pl.DataFrame:
+        """
+        Find the best k matches for each query.
+
+        Args:
+            queries (list[str]): The strings to match.
+            k (int): The number of matches per query.
+            threshold (float): The minimum score of a match, from 0 to 1.
+
+        Returns:
+            pl.DataFrame: The query, id, name and score of each match, best first.
+        """
+        unique = list(dict.fromkeys(q for q in queries if q is not None))
+        query_df = pl.DataFrame(
+            {
+                "query": unique,
+                "trigram": [trigrams(q) for q in unique],
+            },
+            schema={"query": pl.String, "trigram": pl.List(pl.String)},
+        ).with_columns(pl.col("trigram").list.len().alias("q_n"))
+        return (
+            query_df.explode("trigram")
+            .join(self.index, on="trigram")
+            .group_by("query", "q_n", "id", "name")
+            .agg(pl.len().alias("shared"))
+            .join(self.sizes, on=["id", "name"])
+            .with_columns(
+                (2 * pl.col("shared") / (pl.col("q_n") + pl.col("n"))).alias("score")
+            )
+            .filter(pl.col("score") >= threshold)
+            .sort(["query", "score", "id"], descending=[False, True, False])
+            .unique(["query", "id"], keep="first", maintain_order=True)
+            .group_by("query", maintain_order=True)
+            .head(k)
+            .select("query", "id", "name", "score")
+        )
+
+    def match_column(self, col: pl.Series, threshold: float = 0.3) -> pl.Series:
+        """
+        Resolve a column of strings to the id of their best match, or None.
+        """
+        best = self.match(col.to_list(), k=1, threshold=threshold)
+        matches = dict(zip(best.get_column("query"), best.get_column("id")))
+        return col.replace_strict(matches, default=None, return_dtype=pl.String)
@@ -0,0 +1,158 @@
+import hashlib
+import json
+import os
+import threading
+import polars as pl
+
+from src.utils.db.crdb import crdb_connect, fetch_row, iter_table_batches
+
+# Shorter names match too many ordinary words
+MIN_NAME_LENGTH = 3
+
+_gazetteers = {}
+_gazetteer_lock = threading.Lock()
+
+
+def regions_signature(conn: str = "crdb-sage") -> str:
+    """
+    Get a signature of public.regions that changes when regions are updated.
+    """
+    crdb = crdb_connect(conn)
+    count, updated_at = fetch_row(
+        crdb, "SELECT COUNT(*), MAX(updated_at)::STRING FROM public.regions"
+    )
+    return hashlib.sha1(f"{count}:{updated_at}".encode()).hexdigest()[:16]
+
+
+def load_region_names(
+    cache_dir: str, conn: str = "crdb-sage", signature: str = None
+) -> pl.DataFrame:
+    """
+    Get every region name in all languages, cached on disk until regions change.
+
+    Returns:
+        pl.DataFrame: The id, admin_level and name of each region name.
+    """
+    signature = signature or regions_signature(conn)
+    path = os.path.join(cache_dir, "gazetteer", f"regions_{signature}.parquet")
+    if os.path.exists(path):
+        return pl.read_parquet(path)
+
+    rows = []
+    for df in iter_table_batches(
+        "public.regions", "id, admin_level, name::STRING AS name", conn=conn
+    ):
+        for region_id, admin_level, name in df.iter_rows():
+            if name is None:
+                continue
+            names = {
+                n
+                for n in json.loads(name).values()
+                if isinstance(n, str) and len(n) >= MIN_NAME_LENGTH
+            }
+            rows.extend((region_id, admin_level, n) for n in names)
+    names_df = pl.DataFrame(
+        rows,
+        schema={"id": pl.String, "admin_level": pl.Int64, "name": pl.String},
+        orient="row",
+    ).sort("id", "name")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    names_df.write_parquet(path + ".part")
+    os.replace(path + ".part", path)
+    return names_df
+
+
+class RegionGazetteer:
+    """
+    Finds region names in spaCy documents with a case-insensitive PhraseMatcher.
+    """
+
+    def __init__(self, nlp, names: pl.DataFrame, cache_path: str = None):
+        """
+        Args:
+            nlp: The spaCy pipeline whose tokenizer and vocab are used.
+            names (pl.DataFrame): The id, admin_level and name of each region name.
+            cache_path (str): A DocBin file to load the tokenized names from,
+                written on the first build.
+        """
+        from spacy.matcher import PhraseMatcher
+        from spacy.tokens import DocBin
+
+        self.matcher = PhraseMatcher(nlp.vocab, attr="LOWER")
+        self.admin_levels = dict(
+            names.select("id", "admin_level").unique("id").iter_rows()
+        )
+        docs = None
+        if cache_path is not None and os.path.exists(cache_path):
+            docs = list(DocBin().from_disk(cache_path).get_docs(nlp.vocab))
+            if len(docs) != names.height:
+                docs = None
+        if docs is None:
+            docs = list(nlp.tokenizer.pipe(names.get_column("name")))
+            if cache_path is not None:
+                os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+                DocBin(attrs=["ORTH"], docs=docs).to_disk(cache_path + ".part")
+                os.replace(cache_path + ".part", cache_path)
+
+        patterns = {}
+        for region_id, doc in zip(names.get_column("id"), docs):
+            patterns.setdefault(region_id, []).append(doc)
+        for region_id, region_docs in patterns.items():
+            self.matcher.add(region_id, region_docs)
+
+    def match(self, doc, require_propn: bool = True) -> list[dict]:
+        """
+        Find the regions mentioned in a document.
+
+        Args:
+            doc: The spaCy document to scan.
+            require_propn (bool): Only keep spans with a proper noun.
+
+        Returns:
+            list[dict]: The id, admin_level and text of each match.
+        """
+        from spacy.util import filter_spans
+
+        found = self.matcher(doc)
+        # Prefer "New York" over the "York" inside it, keeping every region
+        # that shares a kept span
+        kept = {
+            (span.start, span.end)
+            for span in filter_spans([doc[start:end] for _, start, end in found])
+        }
+        matches = []
+        for match_id, start, end in found:
+            if (start, end) not in kept:
+                continue
+            span = doc[start:end]
+            if require_propn and not any(t.pos_ == "PROPN" for t in span):
+                continue
+            region_id = doc.vocab.strings[match_id]
+            matches.append(
+                {
+                    "id": region_id,
+                    "admin_level": self.admin_levels[region_id],
+                    "text": span.text,
+                }
+            )
+        return matches
+
+
+def region_gazetteer(nlp, cache_dir: str, conn: str = "crdb-sage") -> RegionGazetteer:
+    """
+    Get the region gazetteer for a spaCy pipeline, rebuilding it when regions change.
+    """
+    signature = regions_signature(conn)
+    with _gazetteer_lock:
+        key = id(nlp)
+        cached = _gazetteers.get(key)
+        if cached is None or cached[0] != signature:
+            names = load_region_names(cache_dir, conn, signature)
+            cache_path = os.path.join(
+                cache_dir,
+                "gazetteer",
+                f"regions_{signature}_{nlp.lang}_{nlp.meta.get('name')}"
+                f"_{nlp.meta.get('version')}.spacy",
+            )
+            _gazetteers[key] = (signature, RegionGazetteer(nlp, names, cache_path))
+        return _gazetteers[key][1]
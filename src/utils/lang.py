@@ -1,4 +1,90 @@
+import hashlib
+import threading
+import fasttext
+
 LANG_TO_SPACY_MODEL = {
     "en": "en_core_web_trf",
     "sv": "sv_core_news_lg",
 }
+
+# Components not needed for part-of-speech tags and entities
+SPACY_EXCLUDE = ["parser", "lemmatizer", "senter"]
+
+LID_MODEL_PATH = "data/lid.176.bin"
+LID_CACHE_SIZE = 100_000
+
+_lid_model = None
+_lid_lock = threading.Lock()
+_lid_cache: dict[str, str] = {}
+_spacy_models = {}
+_spacy_lock = threading.Lock()
+
+
+def lid_model():
+    """
+    Get the fastText language identification model, loading it on first use.
+    """
+    global _lid_model
+    if _lid_model is None:
+        with _lid_lock:
+            if _lid_model is None:
+                _lid_model = fasttext.load_model(LID_MODEL_PATH)
+    return _lid_model
+
+
+def detect_languages(texts: list[str], cache: bool = True) -> list[str]:
+    """
+    Detect the language of each text with a single batched prediction.
+
+    Args:
+        texts (list[str]): The texts to classify.
+        cache (bool): Reuse and store results by the hash of each text.
+
+    Returns:
+        list[str]: The ISO 639 code of the most likely language of each text.
+    """
+    keys = [hashlib.sha1(t.encode()).hexdigest() for t in texts]
+    hits = {}
+    missing = {}
+    with _lid_lock:
+        for key, text in zip(keys, texts):
+            if cache and key in _lid_cache:
+                hits[key] = _lid_cache[key]
+            else:
+                missing[key] = text
+    if len(missing) > 0:
+        # fastText predicts one line at a time
+        labels, _ = lid_model().predict(
+            [t.replace("\n", " ") for t in missing.values()]
+        )
+        results = {key: label[0].split("__")[-1] for key, label in zip(missing, labels)}
+        if cache:
+            with _lid_lock:
+                if len(_lid_cache) + len(results) > LID_CACHE_SIZE:
+                    _lid_cache.clear()
+                _lid_cache.update(results)
+        hits.update(results)
+    return [hits[k] for k in keys]
+
+
+def detect_language(text: str) -> str:
+    """
+    Detect the language of a text.
+    """
+    return detect_languages([text])[0]
+
+
+def spacy_model(lang: str):
+    """
+    Get the spaCy pipeline for a language, loading it once per process.
+
+    Components that are not needed for tagging and entities are excluded.
+    """
+    with _spacy_lock:
+        if lang not in _spacy_models:
+            import spacy
+
+            _spacy_models[lang] = spacy.load(
+                LANG_TO_SPACY_MODEL[lang], exclude=SPACY_EXCLUDE
+            )
+        return _spacy_models[lang]
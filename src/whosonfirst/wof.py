@@ -1,13 +1,22 @@
 import os
 from prefect import flow, task
 from prefect.variables import Variable
-from prefect_sqlalchemy import SqlAlchemyConnector
 import polars as pl
 import bz2
-import json
+import shutil
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
+from src.utils import download_file, verify_file
 from src.utils.logging.loggers import get_logger
-from src.utils.db.crdb import create_polars_uri
+from src.utils.db.crdb import (
+    staged_upsert,
+    crdb_connect,
+    execute_with_retry,
+    fetch_row,
+    load_table_ranges,
+)
 from src.cli import setup_cli
 
 placetype_admin = [
@@ -31,52 +40,89 @@ placetype_admin = [
 ]
 
 
-@task
-def load_whosonfirst(country: str, download_url: str):
+def decompress_bz2(filepath: str, extractpath: str, chunk_size: int = 1024 * 1024):
     """
-    Download the Whos On First country data from the given URL.
+    Decompress a bzip2 file without holding it in memory.
+
+    Uses lbzip2 to decompress on all cores when it is installed, otherwise
+    streams the file through the bz2 module in fixed-size chunks. The output
+    is renamed into place only after the whole stream was decompressed.
+    """
+    tmp_path = extractpath + ".part"
+    lbzip2 = shutil.which("lbzip2")
+    if lbzip2:
+        with open(tmp_path, "wb") as f_out:
+            subprocess.run(
+                [lbzip2, "-d", "-c", "-n", str(os.cpu_count() or 1), filepath],
+                stdout=f_out,
+                check=True,
+            )
+    else:
+        with bz2.open(filepath, "rb") as f_in:
+            with open(tmp_path, "wb") as f_out:
+                shutil.copyfileobj(f_in, f_out, chunk_size)
+    os.replace(tmp_path, extractpath)
+
+
+def whosonfirst_basepath() -> str:
+    """
+    Get the absolute base path for the Whos On First downloads.
     """
-    log = get_logger()
-    # Download the file
-    filename = os.path.basename(download_url)
     basepath = Variable.get("whosonfirst_basepath")
     if not basepath:
         basepath = os.path.join(os.getcwd(), "data", "whosonfirst")
         Variable.put("whosonfirst_basepath", basepath)
     if not os.path.isabs(basepath):
         basepath = os.path.join(os.getcwd(), basepath)
+    return basepath
+
+
+def whosonfirst_url(country: str) -> str:
+    return f"https://data.geocode.earth/wof/dist/sqlite/whosonfirst-data-admin-{country.lower()}-latest.db.bz2"
+
+
+@task
+def load_whosonfirst(country: str, download_url: str, basepath: str = None):
+    """
+    Download the Whos On First country data from the given URL.
+    """
+    log = get_logger()
+    # Download the file
+    filename = os.path.basename(download_url)
+    if basepath is None:
+        basepath = whosonfirst_basepath()
     filepath = os.path.join(basepath, country, filename)
 
-    if not os.path.exists(filepath):
+    if not verify_file(filepath):
         log.info(f"Downloading {download_url} to {filepath}")
-        os.system(f"curl -o {filepath} {download_url}")
+        download_file(download_url, filepath)
+        if os.path.exists(filepath[:-4]):
+            os.remove(filepath[:-4])
     else:
         log.info(f"File {filepath} already exists, skipping download.")
 
-    # Extract the bzip2 file using bz2 python module
     extractpath = filepath[:-4]
     if os.path.exists(extractpath):
         log.info(f"File {extractpath} already exists, skipping extraction.")
         return extractpath
     log.info(f"Extracting {filepath}")
-    with bz2.BZ2File(filepath, "rb") as f_in:
-        with open(extractpath, "wb") as f_out:
-            f_out.write(f_in.read())
+    decompress_bz2(filepath, extractpath)
     log.info(f"Extracted {filepath} to {extractpath}")
 
     return extractpath
 
 
 @task
-def transform_whosonfirst(filepath: str):
+def transform_whosonfirst(filepath: str) -> pl.DataFrame:
     """
-    Transform the Whos On First data.
+    Transform the Whos On First data into the rows of the regions load table.
     """
     log = get_logger()
 
+    placetypes = ", ".join([f"'{i[0]}'" for i in placetype_admin])
     names_df = pl.read_database_uri(
         query="SELECT id, placetype, language, script, region, name FROM names WHERE privateuse = 'preferred' "
-        + f"AND placetype IN ({', '.join([f"'{i[0]}'" for i in placetype_admin])})",
+        + f"AND placetype IN ({placetypes})",
         uri=f"sqlite:///{filepath}",
         engine="connectorx",
     )
@@ -109,104 +155,190 @@ def transform_whosonfirst(filepath: str):
         .alias("admin_level")
     )
 
+    # Filter out records that do not have proper hierarchies or placetypes
+    # and drop the name:* and ne:* properties inside of SQLite
     geojson_df = pl.read_database_uri(
-        query="SELECT id, body FROM geojson WHERE is_alt = 0",
+        query=f"""
+            SELECT g.id, json_extract(g.body, '$.geometry') AS geo,
+                json_extract(g.body, '$.properties."wof:placetype"') AS wof_placetype,
+                (
+                    SELECT json_group_object(p.key, CASE
+                        WHEN p.type IN ('object', 'array') THEN json(p.value)
+                        WHEN p.type = 'true' THEN json('true')
+                        WHEN p.type = 'false' THEN json('false')
+                        ELSE p.value END)
+                    FROM json_each(g.body, '$.properties') AS p
+                    WHERE p.key NOT LIKE 'name:%' AND p.key NOT LIKE 'ne:%'
+                ) AS properties,
+                (
+                    SELECT json_group_array(h.value)
+                    FROM json_each(g.body, '$.properties."wof:hierarchy"[0]') AS h
+                    WHERE h.type = 'integer'
+                ) AS hierarchy_ids
+            FROM geojson g
+            WHERE g.is_alt = 0
+            AND json_extract(g.body, '$.properties."wof:placetype"') IN ({placetypes})
+            AND json_type(g.body, '$.properties."wof:hierarchy"[0]') = 'object'
+            AND (
+                SELECT COUNT(*) FROM json_each(g.body, '$.properties."wof:hierarchy"[0]')
+            ) > 1
+        """,
         uri=f"sqlite:///{filepath}",
         engine="connectorx",
     )
-    geojson_df = geojson_df.with_columns(
-        pl.col("body").str.json_path_match("$.geometry").alias("geo"),
-        pl.col("body").str.json_path_match("$.properties").alias("properties"),
+
+    # Create a hierarchy with an admin_level ordering by joining the
+    # exploded hierarchy ids against the places with an admin_level
+    hierarchy_df = (
+        geojson_df.select(
+            "id",
+            pl.col("hierarchy_ids")
+            .str.json_decode(pl.List(pl.Int64))
+            .alias("hierarchy_id"),
+        )
+        .explode("hierarchy_id")
+        .join(
+            lang_df.select(
+                pl.col("id").alias("hierarchy_id"), "placetype", "admin_level"
+            ).filter(pl.col("admin_level").is_not_null()),
+            on="hierarchy_id",
+            how="inner",
+        )
+        .group_by("id")
+        .agg(
+            pl.struct(pl.col("hierarchy_id").alias("id"), "placetype", "admin_level")
+            .sort_by("admin_level", descending=True)
+            .alias("hierarchy")
+        )
     )
-    geojson_df = geojson_df.drop("body")
-
-    def filter_props(props: str) -> dict | None:
-        """
-        Filter out records that do not have proper hierarchies or placetypes.
-        Also create a hierarchy with an admin_level ordering.
-        """
-        props_json = json.loads(props)
-        if "wof:hierarchy" not in props_json or "wof:placetype" not in props_json:
-            return None
-        if props_json["wof:placetype"] not in allowed_placetypes:
-            return None
-        hierarchy = props_json["wof:hierarchy"]
-        if not isinstance(hierarchy, list) or len(hierarchy) < 1:
-            return None
-        if len(hierarchy[0].keys()) <= 1:
-            return None
-        new_props = {}
-        for k, v in props_json.items():
-            if not (k.startswith("name:") or k.startswith("ne:")):
-                new_props[k] = v
-        # Match hierarchy ids to the df and join admin_level
-        new_props["hierarchy"] = []
-        for h in hierarchy[0].values():
-            h_lookup = lang_df.filter(pl.col("id") == h).select(
-                "id", "placetype", "admin_level"
-            )
-            if h_lookup.is_empty():
-                continue
-            h_lookup = h_lookup.to_dicts()[0]
-            if h_lookup["admin_level"]:
-                new_props["hierarchy"].append(
-                    {
-                        "id": h_lookup["id"],
-                        "placetype": h_lookup["placetype"],
-                        "admin_level": h_lookup["admin_level"],
-                    }
-                )
-        # If the hierarchy doesn't look reasonable, skip it
-        if len(new_props["hierarchy"]) < 2 and props_json["wof:placetype"] != "country":
-            return None
-        new_props["hierarchy"] = sorted(
-            new_props["hierarchy"], key=lambda x: x["admin_level"], reverse=True
+    # Records without any matched parents keep an empty hierarchy
+    geojson_df = geojson_df.join(hierarchy_df, on="id", how="left").with_columns(
+        pl.col("hierarchy").fill_null(
+            pl.lit([], dtype=hierarchy_df.schema["hierarchy"])
         )
-
-        return json.dumps(new_props)
-
-    geojson_df = geojson_df.with_columns(
-        pl.col("properties")
-        .map_elements(filter_props, return_dtype=pl.String)
-        .alias("properties")
     )
-    geojson_df = geojson_df.filter(pl.col("properties").is_not_null())
+    # If the hierarchy doesn't look reasonable, skip it
+    geojson_df = geojson_df.filter(
+        (pl.col("hierarchy").list.len() >= 2) | (pl.col("wof_placetype") == "country")
+    )
+    # Add the hierarchy to the properties JSON
+    geojson_df = geojson_df.with_columns(
+        pl.concat_str(
+            pl.col("properties").str.head(-1),
+            pl.lit(","),
+            pl.struct("hierarchy").struct.json_encode().str.tail(-1),
+        ).alias("properties")
+    ).select("id", "geo", "properties")
     combined_df = lang_df.join(geojson_df, on="id", how="inner")
     combined_df = combined_df.drop_nulls(subset=["id"])
     log.info(f"Total records: {combined_df.height}")
 
-    crdb = SqlAlchemyConnector.load("crdb-sage")
-    conn = create_polars_uri(crdb)
+    return combined_df
+
+
+def prepare_whosonfirst(country: str, basepath: str) -> pl.DataFrame:
+    """
+    Download, extract and transform one country.
+    Runs in a worker process when importing several countries.
+    """
+    filepath = load_whosonfirst.fn(country, whosonfirst_url(country), basepath)
+    return transform_whosonfirst.fn(filepath)
+
+
+@task
+def load_regions(combined_df: pl.DataFrame):
+    """
+    Load the transformed regions into public.regions.
+    """
+    crdb = crdb_connect()
+    (started,) = fetch_row(crdb, "SELECT NOW()")
 
-    combined_df.write_database(
-        connection=conn,
-        table_name="databot.regions_wof_load",
-        if_table_exists="replace",
-        engine="adbc",
+    # The xx name is set from wof:name in the upsert, so only the loaded
+    # rows are touched
+    staged_upsert(
+        combined_df,
+        "regions",
+        {
+            "id": "'wof_' || id",
+            "created_at": "NOW()",
+            "updated_at": "NOW()",
+            "name": "JSON_STRIP_NULLS(name::JSONB || JSONB_BUILD_OBJECT('xx', properties::JSONB->'wof:name'))",
+            "geo": "ST_MULTIPOLYFROMWKB(ST_ASEWKB(ST_MULTI(ST_GEOMFROMGEOJSON(geo::JSONB))))",
+            "properties": "properties::JSONB",
+            "placetype": "placetype",
+            "admin_level": "admin_level",
+        },
+        load_table="regions_wof_load",
+        drop=False,
     )
 
-    crdb.execute("ALTER TABLE databot.regions_wof_load ALTER COLUMN id SET NOT NULL;")
+    # Store a bounding box and simplified geometries for cheap lookups.
+    # Tolerances are in degrees: ~10km, ~1km and ~100m.
+    crdb.execute("""
+        CREATE TABLE IF NOT EXISTS databot.regions_geo (
+            id STRING PRIMARY KEY,
+            xmin FLOAT8 NOT NULL,
+            ymin FLOAT8 NOT NULL,
+            xmax FLOAT8 NOT NULL,
+            ymax FLOAT8 NOT NULL,
+            geo_low GEOMETRY(MULTIPOLYGON, 4326),
+            geo_medium GEOMETRY(MULTIPOLYGON, 4326),
+            geo_high GEOMETRY(MULTIPOLYGON, 4326)
+        );
+    """)
+    # A btree on the bounding box can only narrow on xmin, spatial lookups
+    # go through inverted indexes instead
+    crdb.execute("DROP INDEX IF EXISTS databot.regions_geo@regions_geo_bbox_idx;")
+    crdb.execute(
+        "CREATE INVERTED INDEX IF NOT EXISTS regions_geo_low_idx ON databot.regions_geo (geo_low);"
+    )
     crdb.execute(
-        "ALTER TABLE databot.regions_wof_load ALTER PRIMARY KEY USING COLUMNS (id);"
+        "CREATE INVERTED INDEX IF NOT EXISTS regions_geo_medium_idx ON databot.regions_geo (geo_medium);"
     )
+    # Simplify in the same key ranges as the regions upsert, one
+    # transaction per range. Only regions the upsert inserted or changed are
+    # simplified again, and regions that lost their polygon are removed.
+    for where_sql, params in load_table_ranges(crdb, "regions_wof_load"):
+        execute_with_retry(
+            crdb,
+            f"""
+            UPSERT INTO databot.regions_geo (id, xmin, ymin, xmax, ymax, geo_low, geo_medium, geo_high)
+            SELECT l.id, ST_XMIN(g::BOX2D), ST_YMIN(g::BOX2D), ST_XMAX(g::BOX2D), ST_YMAX(g::BOX2D),
+                ST_MULTI(ST_SIMPLIFYPRESERVETOPOLOGY(g, 0.1)),
+                ST_MULTI(ST_SIMPLIFYPRESERVETOPOLOGY(g, 0.01)),
+                ST_MULTI(ST_SIMPLIFYPRESERVETOPOLOGY(g, 0.001))
+            FROM (
+                SELECT 'wof_' || id AS id, ST_MULTI(ST_GEOMFROMGEOJSON(geo::JSONB)) AS g
+                FROM databot.regions_wof_load
+                {where_sql}
+            ) AS l
+            JOIN public.regions r ON r.id = l.id
+            LEFT JOIN databot.regions_geo rg ON rg.id = l.id
+            WHERE GEOMETRYTYPE(g) = 'MULTIPOLYGON'
+            AND (r.updated_at >= :started OR rg.id IS NULL);
+            """,
+            {**params, "started": started},
+        )
+        execute_with_retry(
+            crdb,
+            f"""
+            DELETE FROM databot.regions_geo WHERE id IN (
+                SELECT id FROM (
+                    SELECT 'wof_' || id AS id, ST_MULTI(ST_GEOMFROMGEOJSON(geo::JSONB)) AS g
+                    FROM databot.regions_wof_load
+                    {where_sql}
+                )
+                WHERE g IS NULL OR GEOMETRYTYPE(g) != 'MULTIPOLYGON'
+            );
+            """,
+            params,
+        )
+    # Drop the rows of regions that no longer exist
     crdb.execute("""
-        INSERT INTO public.regions (id, created_at, updated_at, name, geo, properties, placetype, admin_level)
-        SELECT 'wof_' || id, NOW(), NOW(), JSON_STRIP_NULLS(name::JSONB),
-            ST_MULTIPOLYFROMWKB(ST_ASEWKB(ST_MULTI(ST_GEOMFROMGEOJSON(geo::JSONB)))),
-            properties::JSONB, placetype, admin_level
-        FROM databot.regions_wof_load
-        ON CONFLICT (id) DO UPDATE
-        SET placetype = EXCLUDED.placetype,
-            name = JSON_STRIP_NULLS(EXCLUDED.name::JSONB),
-            geo = ST_MULTIPOLYFROMWKB(ST_ASEWKB(ST_MULTI(ST_GEOMFROMGEOJSON(EXCLUDED.geo::JSONB)))),
-            properties = EXCLUDED.properties::JSONB,
-            admin_level = EXCLUDED.admin_level,
-            updated_at = NOW();
+        DELETE FROM databot.regions_geo rg
+        WHERE NOT EXISTS (SELECT 1 FROM public.regions r WHERE r.id = rg.id);
     """)
     crdb.execute("DROP TABLE IF EXISTS databot.regions_wof_load;")
-    crdb.execute(
-        "UPDATE regions SET \"name\" = jsonb_set(\"name\", '{xx}', properties->'wof:name');"
-    )
 
 
 @flow
@@ -223,11 +355,26 @@ def import_whosonfirst_admin(country: list[str], **kwargs):
 
     if len(country) == 0:
         raise ValueError("No country provided. Please specify a country to import.")
-    country = country[0]
-    log.info(f"Importing region data for {country.upper()}...")
-    download_url = f"https://data.geocode.earth/wof/dist/sqlite/whosonfirst-data-admin-{country.lower()}-latest.db.bz2"
-    filepath = load_whosonfirst(country, download_url)
-    transform_whosonfirst(filepath)
+    if len(country) == 1:
+        log.info(f"Importing region data for {country[0].upper()}...")
+        filepath = load_whosonfirst(country[0], whosonfirst_url(country[0]))
+        load_regions(transform_whosonfirst(filepath))
+        return
+
+    # Download, extract and transform the countries in parallel, then load
+    # all of them into the regions table at once
+    log.info(f"Importing region data for {', '.join(c.upper() for c in country)}...")
+    basepath = whosonfirst_basepath()
+    workers = min(len(country), os.cpu_count() or 1)
+    with ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+    ) as pool:
+        dfs = list(pool.map(prepare_whosonfirst, country, [basepath] * len(country)))
+    combined_df = pl.concat(dfs, how="vertical_relaxed").unique(
+        subset=["id"], keep="first", maintain_order=True
+    )
+    log.info(f"Total records for all countries: {combined_df.height}")
+    load_regions(combined_df)
 
 
 if __name__ == "__main__":
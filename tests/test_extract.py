@@ -0,0 +1,15 @@
+import time
+
+from src.utils.extract import extract_any_json
+
+
+def test_extract_any_json():
+    s = 'Here you go: [{"name": "a"}] and {"name": "b"} {not json}'
+    assert extract_any_json(s) == [[{"name": "a"}], {"name": "b"}]
+
+
+def test_extract_any_json_deeply_nested():
+    start = time.monotonic()
+    assert extract_any_json('{"a":' * 20_000) == []
+    assert extract_any_json("[" * 20_000 + ' {"name": "a"}') == [{"name": "a"}]
+    assert time.monotonic() - start < 5